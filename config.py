@@ -52,6 +52,17 @@ class SafeLevels(registry.OnlySomeStrings):
 class EngineAPI(registry.OnlySomeStrings):
     validStrings = ('cse', 'legacy')
 
+class TransportMode(registry.OnlySomeStrings):
+    validStrings = ('http', 'record', 'replay')
+
+class NonNegativeFloat(registry.Float):
+    errormsg = _('Value must be a non-negative floating-point number, not '
+            '%r.')
+    def setValue(self, v):
+        if v < 0:
+            self.error(v)
+        super(NonNegativeFloat, self).setValue(v)
+
 GoogleCSE = conf.registerPlugin('GoogleCSE')
 # This is where your configuration variables (if any) should go.  For example:
 # conf.registerGlobalValue(GoogleCSE, 'someConfigVariableName',
@@ -62,6 +73,10 @@ conf.registerGlobalValue(GoogleCSE, 'apikey',
 conf.registerGlobalValue(GoogleCSE, 'engines',
     registry.CommaSeparatedListOfStrings('', _("""List of available Custom
         Search Engines.""")))
+conf.registerGlobalValue(GoogleCSE, 'federatedTimeout',
+    registry.PositiveFloat(3.0, _("""Number of seconds a search of all
+    engines (search --all) waits for the engines. Results of engines that
+    answer later are left out.""")))
 conf.registerChannelValue(GoogleCSE, 'defaultEngine',
     registry.String('', _("""Default Custom Search Engine for channel."""),
         private=True))
@@ -69,6 +84,9 @@ conf.registerChannelValue(GoogleCSE, 'maxPageResults',
     registry.Integer(10, _("""Maximum number of page results to fetch.""")))
 conf.registerChannelValue(GoogleCSE, 'maxPages',
     registry.Integer(1, _("""Maximum number of page results to fetch.""")))
+conf.registerChannelValue(GoogleCSE, 'prefetchPages',
+    registry.Boolean(False, _("""Fetch all maxPages pages concurrently when
+    searching, so nextpage does not wait for a request.""")))
 conf.registerChannelValue(GoogleCSE, 'maxDisplayResults',
     registry.Integer(5, _("""Maximum number of page results to display.""")))
 conf.registerChannelValue(GoogleCSE, 'includeSnippet',
@@ -78,5 +96,117 @@ conf.registerChannelValue(GoogleCSE, 'safeLevel',
 conf.registerChannelValue(GoogleCSE, 'engineAPI',
     EngineAPI('cse', _("""Select google engine mode. \"legacy\" sets the
     old google API \"cse\" sets the latest CSE API. Default: cse.""")))
+conf.registerGlobalValue(GoogleCSE, 'cache',
+    registry.Boolean(True, _("""Store search results in a permanent sqlite3
+    cache and serve repeated searches from it.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheTTL',
+    registry.PositiveInteger(86400, _("""Number of seconds a cached search
+    result remains valid.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheMaxEntries',
+    registry.PositiveInteger(1000, _("""Maximum number of cached result pages.
+    The least recently used pages are removed first.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheEmptyTTL',
+    registry.NonNegativeInteger(3600, _("""Number of seconds a search without
+    results is remembered, so repeating it does not use quota. 0 to not
+    remember them.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheErrorTTL',
+    registry.NonNegativeInteger(600, _("""Number of seconds a search rejected
+    by Google as invalid (HTTP 400 or 404) is remembered and answered with
+    the same error. 0 to not remember them.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheStale',
+    registry.NonNegativeInteger(86400, _("""Number of seconds an expired
+    cached search result is kept to answer searches that would otherwise miss
+    searchTimeout.""")))
+conf.registerGlobalValue(GoogleCSE, 'unorderedQueries',
+    registry.Boolean(False, _("""Treat searches with the same words in a
+    different order as the same search for the cache and for coalescing
+    identical requests.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheRefresh',
+    registry.NonNegativeInteger(0, _("""Number of seconds between checks for
+    popular cached searches about to expire, which are then fetched again in
+    the background. 0 disables refreshing.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheRefreshMargin',
+    registry.PositiveInteger(900, _("""Cached searches expiring within this
+    number of seconds are refreshed. Should be larger than cacheRefresh.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheRefreshMinHits',
+    registry.PositiveInteger(2, _("""Minimum number of cache hits for a search
+    to be refreshed.""")))
+conf.registerGlobalValue(GoogleCSE, 'cacheRefreshQuota',
+    registry.Probability(0.1, _("""Maximum share of the remaining daily quota
+    a refresh check may use.""")))
+conf.registerGlobalValue(GoogleCSE, 'poolSize',
+    registry.PositiveInteger(10, _("""Maximum number of keep-alive HTTP
+    connections kept open to the Google API.""")))
+conf.registerGlobalValue(GoogleCSE, 'connectTimeout',
+    registry.PositiveFloat(5.0, _("""Number of seconds to wait for a
+    connection to the Google API.""")))
+conf.registerGlobalValue(GoogleCSE, 'readTimeout',
+    registry.PositiveFloat(10.0, _("""Number of seconds to wait for a response
+    from the Google API.""")))
+conf.registerGlobalValue(GoogleCSE, 'retries',
+    registry.NonNegativeInteger(2, _("""Number of times a request failing
+    with a server or network error is retried.""")))
+conf.registerGlobalValue(GoogleCSE, 'retryBackoff',
+    registry.PositiveFloat(0.5, _("""Retries wait a random number of seconds
+    up to retryBackoff, doubled for each further retry.""")))
+conf.registerGlobalValue(GoogleCSE, 'breakerThreshold',
+    registry.PositiveInteger(5, _("""Number of consecutive failed requests
+    after which searches fail right away for breakerCooldown seconds. Rate
+    limit errors stop requests at once.""")))
+conf.registerGlobalValue(GoogleCSE, 'breakerCooldown',
+    registry.PositiveInteger(60, _("""Number of seconds searches fail right
+    away after the request failures set by breakerThreshold. Then a single
+    request tests whether the Google API works again.""")))
+conf.registerGlobalValue(GoogleCSE, 'transport',
+    TransportMode('http', _("""How requests reach the Google API. \"http\"
+    sends them, \"record\" sends them and saves the responses in
+    cassetteDirectory and \"replay\" answers them from the saved responses
+    without any network access. Default: http.""")))
+conf.registerGlobalValue(GoogleCSE, 'cassetteDirectory',
+    registry.String('', _("""Directory of the responses saved and replayed by
+    the record and replay transports. Defaults to GoogleCSE-cassettes in the
+    bot's data directory.""")))
+conf.registerGlobalValue(GoogleCSE, 'searchTimeout',
+    NonNegativeFloat(8.0, _("""Number of seconds a search or nextpage
+    command may take, from the cache lookup to the reply. Late responses are
+    replaced by an expired cached copy if there is one, and cached when they
+    arrive. 0 means no limit.""")))
+conf.registerGlobalValue(GoogleCSE, 'threadedSearch',
+    registry.Boolean(False, _("""Run searches on a pool of worker threads so
+    a slow response does not block other commands. Results are replied when
+    they arrive.""")))
+conf.registerGlobalValue(GoogleCSE, 'workerThreads',
+    registry.PositiveInteger(4, _("""Number of worker threads used when
+    threadedSearch is enabled.""")))
+conf.registerGlobalValue(GoogleCSE, 'workerQueueSize',
+    registry.PositiveInteger(16, _("""Maximum number of searches waiting for a
+    worker thread. Further searches are refused until the queue drains.""")))
+conf.registerGlobalValue(GoogleCSE, 'dailyQuota',
+    registry.PositiveInteger(100, _("""Maximum number of requests per day for
+    an API key. Searches are refused once the quota is used up.""")))
+conf.registerGlobalValue(GoogleCSE, 'requestsPerSecond',
+    registry.PositiveFloat(10.0, _("""Maximum number of requests per second
+    for an API key. Further requests wait for their turn.""")))
+conf.registerChannelValue(GoogleCSE, 'channelDailyQuota',
+    registry.NonNegativeInteger(0, _("""Maximum number of requests per day
+    from the channel, taken from the API key's daily quota. 0 means no channel
+    limit.""")))
+conf.registerGlobalValue(GoogleCSE, 'metricsFile',
+    registry.String('', _("""File the search latency histograms and counters
+    are written to every metricsInterval seconds, in the Prometheus text
+    format. Empty to disable.""")))
+conf.registerGlobalValue(GoogleCSE, 'metricsInterval',
+    registry.PositiveInteger(60, _("""Number of seconds between writes of the
+    metrics file.""")))
+conf.registerGlobalValue(GoogleCSE, 'maxSessions',
+    registry.PositiveInteger(100, _("""Maximum number of channels and nicks
+    whose search results are kept for navigation. The least recently used
+    session is dropped first.""")))
+conf.registerGlobalValue(GoogleCSE, 'sessionTimeout',
+    registry.PositiveInteger(3600, _("""Number of seconds an unused search
+    session is kept.""")))
+conf.registerGlobalValue(GoogleCSE, 'maxSessionMemory',
+    registry.NonNegativeInteger(10485760, _("""Approximate maximum number of
+    bytes used by all search sessions. 0 means no limit.""")))
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -13,6 +13,10 @@
 # limitations under the License.
 import sys
 import json
+import collections
+import time
+import random
+import threading
 from xml.sax.saxutils import unescape
 
 if sys.version_info[0] < 3:
@@ -21,12 +25,11 @@ else:
     from urllib.parse import unquote
 
 from .exceptions import *
-from .utils import ItemIndexTree
+from .utils import (ItemIndexTree, SingleFlight, normalizeQuery, normalizeURL,
+        interleave, within, CircuitBreaker)
 
-try:
-    import requests
-except:
-    raise ImportError('Please install the requests package')
+from .transport import HTTPTransport, Response
+from .metrics import metrics, clock
 
 def recode(s):
     if sys.version_info[0] < 3:
@@ -37,6 +40,22 @@ def reformat(s):
     extra = {'&quot;': '"', '&apos;': "'"}
     return unescape(unquote(s), extra)
 
+httpTransport = HTTPTransport()
+flight = SingleFlight()
+breaker = CircuitBreaker()
+
+# Errors worth retrying: server side failures and network errors.
+TRANSIENT_STATUS = (500, 502, 503, 504)
+TRANSIENT_REASONS = ('backendError', 'internalError')
+# Errors opening the circuit breaker right away.
+RATE_LIMIT_STATUS = (429,)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded',
+    'dailyLimitExceeded')
+# Errors kept by the negative cache: the same request fails the same way,
+# unless the error is about the API key, which request keys leave out.
+NEGATIVE_STATUS = (400, 404)
+KEY_REASONS = ('keyInvalid', 'keyExpired')
+
 def searchEngine(engine, query, params, **kwargs):
     if engine == 'cse':
         cls = CSE
@@ -45,24 +64,124 @@ def searchEngine(engine, query, params, **kwargs):
     return cls(query, params, **kwargs)
 
 
+class Item(object):
+    """Search result item.
+
+    Only the raw title, link and snippet strings of the result are kept.
+    Each is decoded on first access and the decoded value is reused, as are
+    output lines built with rendered().
+    """
+    __slots__ = ('_raw', '_title', '_link', '_snippet', '_lines')
+    titleKey = None
+    linkKey = None
+    snippetKey = None
+
+    def __init__(self, data):
+        self._raw = self.raw(data)
+        self._title = None
+        self._link = None
+        self._snippet = None
+        self._lines = None
+
+    def __repr__(self):
+        return recode('\"{0}\"').format(self.title)
+
+    @classmethod
+    def raw(cls, data):
+        """Return the raw (title, link, snippet) of result data."""
+        return (data[cls.titleKey], data[cls.linkKey],
+                data.get(cls.snippetKey, ''))
+
+    def sizeof(self):
+        """Return the approximate memory used by the item in bytes."""
+        size = sys.getsizeof(self)
+        for v in (self._raw, self._title, self._link, self._snippet):
+            size += sys.getsizeof(v)
+        if self._lines:
+            size += sys.getsizeof(self._lines)
+            for line in self._lines.values():
+                size += sys.getsizeof(line)
+        return size
+
+    def rendered(self, key, render):
+        """Return render(self), memoized per key. key must identify every
+        option render depends on."""
+        if self._lines is None:
+            self._lines = {}
+        line = self._lines.get(key)
+        if line is None:
+            line = self._lines[key] = render(self)
+        return line
+
+    @property
+    def title(self):
+        if self._title is None:
+            self._title = reformat(self._raw[0])
+        return self._title
+
+    @property
+    def link(self):
+        if self._link is None:
+            self._link = reformat(self._raw[1])
+        return self._link
+
+    @property
+    def snippet(self):
+        if self._snippet is None:
+            self._snippet = reformat(self._raw[2])
+        return self._snippet
+
+
+class LegacyItem(Item):
+    """Legacy API result item."""
+    __slots__ = ()
+    titleKey = 'titleNoFormatting'
+    linkKey = 'url'
+    snippetKey = 'content'
+
+
+class CSEItem(Item):
+    """CSE API result item."""
+    __slots__ = ()
+    titleKey = 'title'
+    linkKey = 'link'
+    snippetKey = 'snippet'
+
+
 class BaseItems(ItemIndexTree):
-    """Base Items Class."""
-    def __init__(self, data=None, items=None):
+    """Base Items Class. Holds the Item instances of a page.
+
+    If a seen set is given, results whose normalized link is in it are
+    skipped and the links of the added items are added to it.
+    """
+    Item = Item
+
+    def __init__(self, items=None, seen=None):
         ItemIndexTree.__init__(self)
-        self.data = data
         if isinstance(items, list):
+            linkKey = self.Item.linkKey
             for d in items:
-                self.append(self.__class__(data=d))
-        self._title = None
-        self._link = None
-        self._snippet = None
-    
+                if seen is not None:
+                    url = normalizeURL(d[linkKey])
+                    if url in seen:
+                        continue
+                    seen.add(url)
+                list.append(self, self.Item(d))
+
+    def _check_ins(self, item):
+        if not isinstance(item, Item):
+            raise TypeError('Item must be of type {0}'.format(str(Item)))
+
+    def append(self, item):
+        self._check_ins(item)
+        list.append(self, item)
+
+    def __getitem__(self, index):
+        return list.__getitem__(self, index)
+
     def __repr__(self):
-        if self.parent is None:
-            return recode('ROOT ItemIndex Current Item: ')+self.current.__repr__()
-        else:
-            return recode('\"{0}\"').format(self.title)
-    
+        return recode('ROOT ItemIndex Current Item: ')+self.current.__repr__()
+
     def next(self):
         super(BaseItems, self).next()
         return self.current
@@ -70,50 +189,50 @@ class BaseItems(ItemIndexTree):
     def previous(self):
         super(BaseItems, self).previous()
         return self.current
-    
+
     @property
     def title(self):
-        if self.parent is None:
-            return reformat(self.current.data[self._title])
-        return reformat(self.data[self._title])
+        return self.current.title
 
     @property
     def link(self):
-        if self.parent is None:
-            return reformat(self.current.data[self._link])
-        return reformat(self.data[self._link])
+        return self.current.link
 
     @property
     def snippet(self):
-        if self.parent is None:
-            return reformat(self.current.data[self._snippet])
-        return reformat(self.data[self._snippet])
+        return self.current.snippet
 
 
 class LegacyItems(BaseItems):
     """Legacy Item Class."""
-    def __init__(self, data=None, items=None):
-        super(LegacyItems, self).__init__(data=data, items=items)
-        self._link = 'url'
-        self._title = 'titleNoFormatting'
-        self._snippet = 'content'
+    Item = LegacyItem
 
 
 class CSEItems(BaseItems):
     """Request Page Item instance."""
-    def __init__(self, data=None, items=None):
-        super(CSEItems, self).__init__(data=data, items=items)
-        self._link = 'link'
-        self._title = 'title'
-        self._snippet = 'snippet'
+    Item = CSEItem
+
+
+class PageInfo(collections.namedtuple('PageInfo',
+        'title startIndex count totalResults')):
+    """Metadata of a result page."""
+    __slots__ = ()
 
 
 class BasePages(ItemIndexTree):
-    """Base class for Pages."""
-    def __init__(self):
+    """Base class for Pages.
+
+    A page keeps its PageInfo and the raw (title, link, snippet) strings of
+    its items, extracted by ingest(); the response data is not referenced.
+    """
+    def __init__(self, data=None, seen=None):
         super(BasePages, self).__init__()
-        self.data = None
+        self.info = None
         self.items = None
+        if data:
+            self.info, results = self.ingest(data)
+            if results:
+                self.items = self.ItemsClass(items=results, seen=seen)
     
     def __repr__(self):
         if self.parent is None:
@@ -125,6 +244,29 @@ class BasePages(ItemIndexTree):
     @property
     def currentItem(self):
         return self.items.current
+
+    @property
+    def data(self):
+        """The PageInfo fields as a dict."""
+        if self.info is None:
+            return self.current.data
+        return dict(self.info._asdict())
+
+    @classmethod
+    def ingest(cls, data):
+        """Return the PageInfo and the result dicts of response data."""
+        raise NotImplementedError
+
+    @classmethod
+    def results(cls, data):
+        """Return the result dicts of response data."""
+        raise NotImplementedError
+
+    @classmethod
+    def documents(cls, data):
+        """Return the raw (title, link, snippet) of the results in response
+        data."""
+        return [cls.ItemsClass.Item.raw(d) for d in cls.results(data)]
     
     def next(self):
         super(BasePages, self).next()
@@ -139,64 +281,86 @@ class BasePages(ItemIndexTree):
 
     def previousItem(self):
         return self.items.previous()
+
+    def itemWindow(self, n, direction='next'):
+        """Return up to n items after (or before, with direction
+        'previous') the current item and move to them. See
+        ItemIndexTree.window()."""
+        if self.items is None:
+            return []
+        return self.items.window(n, direction)
     
     @property
     def startIndex(self):
-        if self.parent is None:
-            return self.current.data['startIndex']
-        return self.data['startIndex']
+        if self.info is None:
+            return self.current.info.startIndex
+        return self.info.startIndex
     
     @property
     def title(self):
-        if self.parent is None:
-            return self.current.data['title']
-        return self.data['title']
+        if self.info is None:
+            return self.current.info.title
+        return self.info.title
 
     @property
     def count(self):
-        if self.parent is None:
-            return self.current.data['count']
-        return self.data['count']
+        if self.info is None:
+            return self.current.info.count
+        return self.info.count
+
+    @property
+    def totalResults(self):
+        if self.info is None:
+            return self.current.info.totalResults
+        return self.info.totalResults
 
 
 class LegacyPages(BasePages):
     """Legacy Page instances."""
     ItemsClass = LegacyItems
 
-    def __init__(self, data=None):
-        super(LegacyPages, self).__init__()
-        if data:
-            self.data = data['responseData']
-            if data['responseData']['results']:
-                self.items = self.ItemsClass(items=data['responseData']['results'])
-                self.data['count'] = len(self.items)
-                cpi = self.data['cursor']['currentPageIndex']
-            else:
-                self.data['count'] = 0
-                cpi = 0
-
-            if cpi > 0:
-                self.data['startIndex'] = cpi * len(self.items)
-            else:
-                self.data['startIndex'] = cpi
-            self.data['title'] = 'Legacy API Search Results'
+    @classmethod
+    def ingest(cls, data):
+        results = cls.results(data)
+        cpi = 0
+        total = 0
+        if results:
+            cursor = data['responseData']['cursor']
+            cpi = cursor['currentPageIndex']
+            try:
+                total = int(cursor['estimatedResultCount'])
+            except (KeyError, ValueError):
+                total = len(results)
+        return PageInfo('Legacy API Search Results', cpi * len(results),
+                len(results), total), results
+
+    @classmethod
+    def results(cls, data):
+        return data['responseData']['results'] or []
     
 
 class CSEPages(BasePages):
     """Request Page instances."""
     ItemsClass = CSEItems
-    def __init__(self, data=None):
-        super(CSEPages, self).__init__()
-        if data:
-            self.data = data['queries']['request'][0]
-            try:
-                total = int(self.data['totalResults'])
-            except:
-                total = 0
-            if total > 0:
-                self.items = self.ItemsClass(items=data['items'])
-            else:
-                self.data['count'] = total
+
+    @classmethod
+    def ingest(cls, data):
+        request = data['queries']['request'][0]
+        try:
+            total = int(request['totalResults'])
+        except:
+            total = 0
+        title = request.get('title', '')
+        # Responses without results leave out startIndex.
+        startIndex = request.get('startIndex', 1)
+        if total > 0:
+            return PageInfo(title, startIndex, request['count'], total), \
+                cls.results(data)
+        return PageInfo(title, startIndex, 0, 0), []
+
+    @classmethod
+    def results(cls, data):
+        return data.get('items') or []
 
 
 class API(object):
@@ -216,56 +380,344 @@ class API(object):
 
 class EngineBase(dict):
     """Base Engine class."""
+    api = None
     url = None
-    _test_feed = False
+    numParam = None
+    # Exceptions of the transport retried like server errors.
+    networkErrors = (EnvironmentError,)
 
     def __init__(self, query, params, **kwargs):
         self['q'] = query
         self.pages = None
-        self.response = None
+        self.cache = kwargs.get('cache')
+        self.useCache = kwargs.get('useCache', True)
+        self.uncached = []
+        self.transport = kwargs.get('transport', httpTransport)
+        self.prefetch = kwargs.get('prefetch', False)
+        self.flight = kwargs.get('flight', flight)
+        self.limiter = kwargs.get('limiter')
+        self.channel = kwargs.get('channel')
+        self.channelQuota = kwargs.get('channelQuota', 0)
+        self.metrics = kwargs.get('metrics', metrics)
+        self.unordered = kwargs.get('unordered', False)
+        self.seen = kwargs.get('seen', set())
+        self.deadline = kwargs.get('deadline')
+        self.breaker = kwargs.get('breaker', breaker)
+        self.retries = kwargs.get('retries', 2)
+        self.backoff = kwargs.get('backoff', 0.5)
+        # Held while moving between pages, so concurrent next() calls fetch
+        # one page after the other.
+        self._lock = threading.RLock()
         try:
             self.maxPages = params.pop('maxPages')
         except:
             self.maxPages = 1
 
     def next(self):
-        if not self.pages:
-            self._execute()
-            self.pages.next()
-        else:
-            try:
-                if self.maxPages > len(self.pages) and self.maxPages != 0:
+        with self._lock:
+            if not self.pages:
+                if self.prefetch and self.maxPages > 1:
+                    self._prefetch()
+                else:
+                    self._execute()
+                self.pages.next()
+            else:
+                if not self.pages.hasNext() and \
+                        self.maxPages > len(self.pages) and \
+                        self.maxPages != 0:
                     self['start'] = self.pages.current.startIndex + \
                         self.pages.current.count
                     self._execute()
-            finally:
                 self.pages.next()
 
-        return self.pages.current
+            return self.pages.current
     
     def previous(self):
-        self.pages.previous()
-        self['start'] = self.pages.current.startIndex
-        return self.pages.current
+        with self._lock:
+            self.pages.previous()
+            self['start'] = self.pages.current.startIndex
+            return self.pages.current
     
+    def hasNext(self):
+        """Return True if next() has a page to move to, fetched or not."""
+        if not self.pages:
+            return True
+        return self.pages.hasNext() or \
+                self.maxPages != 0 and self.maxPages > len(self.pages)
+
+    def hasPrevious(self):
+        return bool(self.pages) and self.pages.hasPrevious()
+
     @property
     def currentPage(self):
         return self.pages.current
 
-    def _execute(self):
-        if self._test_feed:
-            self._test_feed = False
-        else:
-            response = requests.get(self.url, params=self)
-            self.response = response
-        if self.eval_status_code(self.response) == 200:
-            self.pages.append(self.Pages(self.response.json()))
+    def memoryUsage(self):
+        """Return the approximate memory used by the fetched pages in
+        bytes."""
+        size = 0
+        for page in list.__iter__(self.pages or []):
+            size += sys.getsizeof(page) + sys.getsizeof(page.info)
+            for item in list.__iter__(page.items or []):
+                size += item.sizeof()
+        if self.seen:
+            size += sys.getsizeof(self.seen)
+            for url in self.seen:
+                size += sys.getsizeof(url)
+        return size
+
+    def requestKey(self, params=None):
+        """Return the key identifying the request params (default: the
+        current request). The query is canonical (see normalizeQuery),
+        ignoring word order with unordered=True; it is sent as given."""
+        if params is None:
+            params = self
+        return (self.api, params.get('cx'),
+            normalizeQuery(params['q'], self.unordered),
+            params.get('start'), params.get(self.numParam),
+            params.get('safe'), params.get('fields'))
+
+    def pageStart(self, index):
+        """Return the start parameter of page index."""
+        raise NotImplementedError
+
+    def saveCache(self):
+        """Store responses fetched with useCache disabled, which neither
+        reads nor writes the cache. Returns the number of responses
+        stored."""
+        if self.cache is None:
+            return 0
+        count = len(self.uncached)
+        while self.uncached:
+            self._cacheSet(*self.uncached.pop(0))
+        return count
+
+    def refresh(self):
+        """Request the current page again, bypassing the cache, and replace
+        its cached response. Returns the response data."""
+        key = self.requestKey()
+        data, shared = self.flight.do(key, lambda: self._send(self))
+        if self.cache is not None and not shared:
+            self._cacheSet(key, data, True)
+        return data
+
+    def _fetch(self, params):
+        """Return the response data for the request params.
+
+        The cache is read first, including negative outcomes: a kept error is
+        raised again without a request. Identical requests in flight at the
+        same time, from any engine, share one request through the
+        SingleFlight. With a Deadline, a request not answered in time is left
+        to finish in the background and store its response, and the expired
+        cached copy is returned instead, right away if the 95th percentile of
+        the request latency exceeds the time left; without a copy
+        SearchTimeoutError is raised.
+        """
+        key = self.requestKey(params)
+        data = self._cached(key)
+        if data is not None:
+            return data
+        if self.deadline is None:
+            return self._fetchData(key, params)
+        stale = self._cachedStale(key)
+        call = within(lambda: self._fetchData(key, params),
+                self._timeout(stale))
+        if not call.event.is_set():
+            return self._missedDeadline(stale)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _fetchData(self, key, params):
+        try:
+            data, shared = self.flight.do(key, lambda: self._send(params))
+        except GoogleAPIError as e:
+            self._storeError(key, e)
+            raise
+        if shared:
+            self.metrics.incr('flight.shared')
+        self._store(key, data, shared)
+        return data
+
+    def _cached(self, key):
+        if self.cache is not None and self.useCache:
+            negative = self.cache.getNegative(key)
+            if negative is not None:
+                self.metrics.incr('cache.negative')
+                status, data = negative
+                if status != 200:
+                    raise GoogleAPIError(self.__class__,
+                            Response(status, data))
+                return data
+            data = self.cache.get(key)
+            self.metrics.incr('cache.miss' if data is None else 'cache.hit')
+            return data
+
+    def _cachedStale(self, key):
+        if self.cache is not None and self.useCache:
+            return self.cache.getStale(key)
+
+    def _timeout(self, stale):
+        """Return the seconds to wait for a response within the deadline, 0
+        if the stale data should be used right away."""
+        remaining = self.deadline.remaining()
+        if stale is not None and \
+                remaining < self.metrics.percentile('http', 95):
+            return 0
+        return remaining
+
+    def _missedDeadline(self, stale):
+        if stale is not None:
+            self.metrics.incr('cache.stale')
+            return stale
+        self.metrics.incr('deadline.exceeded')
+        raise SearchTimeoutError('No response within {0} seconds.'.format(
+            self.deadline.seconds))
+
+    def _store(self, key, data, shared=False):
+        if self.cache is not None:
+            if not self.useCache:
+                self.uncached.append((key, data))
+            elif not shared:
+                self._cacheSet(key, data)
+
+    def _cacheSet(self, key, data, refreshed=False):
+        documents = self.Pages.documents(data)
+        if documents:
+            self.cache.set(key, data, documents, self['q'], refreshed)
         else:
-            raise GoogleAPIError(self.__class__, self.response)
+            self.cache.setNegative(key, data)
+
+    def _storeError(self, key, error):
+        """Keep an error with a status in NEGATIVE_STATUS, other than an API
+        key error, as a negative outcome (see ResultCache.setNegative)."""
+        if self.cache is not None and self.useCache and \
+                error.data is not None and \
+                error.status in NEGATIVE_STATUS and \
+                error.reason not in KEY_REASONS:
+            self.cache.setNegative(key, error.data, error.status)
+
+    def _send(self, params):
+        """Request params and return the decoded response data. Transient
+        errors (server and network errors) are retried up to retries times
+        after a random delay of up to backoff * 2 ** attempt seconds, if the
+        deadline leaves time for it. Raises CircuitOpenError without a
+        request while the breaker is open."""
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            try:
+                data = self._decode(self._request(params))
+            except (GoogleAPIError,) + self.networkErrors as e:
+                delay = self._failed(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return data
+
+    def _failed(self, error, attempt):
+        """Record the error of a request in the circuit breaker, which rate
+        limit errors open at once. Returns the seconds to wait before
+        retrying, None if error is final."""
+        status = getattr(error, 'status', None)
+        reason = getattr(error, 'reason', None)
+        if status in RATE_LIMIT_STATUS or reason in RATE_LIMIT_REASONS:
+            self.metrics.incr('breaker.tripped')
+            self.breaker.trip()
+            return None
+        if not isinstance(error, self.networkErrors) and \
+                status not in TRANSIENT_STATUS and \
+                reason not in TRANSIENT_REASONS:
+            # Google answered; retrying the same request would not help.
+            self.breaker.success()
+            return None
+        self.breaker.failure()
+        if attempt >= self.retries:
+            return None
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if self.deadline is not None and delay >= self.deadline.remaining():
+            return None
+        self.metrics.incr('retries')
+        return delay
+
+    def _request(self, params):
+        """Take quota for the request from the limiter, charged to the API
+        key and the channel, and send it."""
+        if self.limiter is not None:
+            try:
+                self.limiter.acquire(params.get('key'), self.channel,
+                        self.channelQuota)
+            except QuotaExceededError:
+                self.metrics.incr('quota.refused')
+                raise
+        self.metrics.incr('requests')
+        with self.metrics.timer('http'):
+            return self.transport.get(self.url, params)
+
+    def _decode(self, response):
+        if self.eval_status_code(response) != 200:
+            self.metrics.incr('errors')
+            raise GoogleAPIError(self.__class__, response)
+        with self.metrics.timer('decode'):
+            return response.json()
+
+    def _parse(self, data):
+        with self.metrics.timer('parse'):
+            return self.Pages(data, self.seen)
+
+    def _execute(self):
+        self.pages.append(self._parse(self._fetch(self)))
+
+    def _prefetch(self):
+        """Fetch the first maxPages pages concurrently, on the first next()
+        with prefetch=True. Pages after an empty or failed page are dropped
+        and maxPages is reduced to match."""
+        batch = self._prefetchBatch()
+        results = [None] * len(batch)
+
+        def fetch(index):
+            try:
+                results[index] = (self._fetch(batch[index]), None)
+            except Exception as e:
+                results[index] = (None, e)
+
+        threads = [threading.Thread(target=fetch, args=(index,))
+                for index in range(len(batch))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._prefetched(results)
+
+    def _prefetchBatch(self):
+        batch = [dict(self)]
+        for index in range(1, self.maxPages):
+            params = dict(self)
+            params['start'] = self.pageStart(index)
+            batch.append(params)
+        return batch
+
+    def _prefetched(self, results):
+        """Append prefetched (data, error) results in page order."""
+        for index, (data, error) in enumerate(results):
+            if error is not None:
+                if index == 0:
+                    raise error
+                break
+            page = self._parse(data)
+            if index > 0 and page.count == 0:
+                break
+            self.pages.append(page)
+        self.maxPages = len(self.pages)
 
 
 class Legacy(EngineBase):
     """Legacy Search Engine."""
+    api = 'legacy'
+    numParam = 'rsz'
     Pages = LegacyPages
     url = 'http://ajax.googleapis.com/ajax/services/search/web'
 
@@ -282,14 +734,27 @@ class Legacy(EngineBase):
             n = 8
         self['rsz'] = n
 
+    def pageStart(self, index):
+        return index * self.get('rsz', 4)
+
     def eval_status_code(self, response):
+        if response.status_code != 200:
+            return response.status_code
         return response.json()['responseStatus']
 
 
 class CSE(EngineBase):
-    """Google Custom Search Engine."""
+    """Google Custom Search Engine.
+
+    Only the response fields read by CSEPages are requested, without the
+    snippets if params['snippet'] is false. params['fields'] overrides the
+    selection; an empty value requests the full response.
+    """
+    api = 'cse'
+    numParam = 'num'
     Pages = CSEPages
     url = 'https://www.googleapis.com/customsearch/v1'
+    fields = 'queries(request(startIndex,count,totalResults,title)),items({0})'
 
     def __init__(self, query, params, **kwargs):
         super(CSE, self).__init__(query, params, **kwargs)
@@ -300,8 +765,22 @@ class CSE(EngineBase):
             self.setEngine(None)
         
         self.setNumber(params.get('number'))
+        self.setFields(params.get('fields',
+            self.partialFields(params.get('snippet', True))))
         self.pages = self.Pages()
 
+    @classmethod
+    def partialFields(cls, snippet=True):
+        """Return the fields parameter selecting the used response fields."""
+        return cls.fields.format('title,link,snippet' if snippet else
+                'title,link')
+
+    def setFields(self, fields):
+        if fields:
+            self['fields'] = fields
+        else:
+            self.pop('fields', None)
+
     def setEngine(self, engine_id):
         if engine_id is None:
             raise CSEAPIError('Engine ID cannot be None.')
@@ -311,7 +790,143 @@ class CSE(EngineBase):
         if type(n) == int:
             self['num'] = n
 
+    def pageStart(self, index):
+        return 1 + index * self.get('num', 10)
+
     def eval_status_code(self, response):
         return response.status_code
 
+class CacheResults(EngineBase):
+    """Pages of raw (title, link, snippet) items found in the cache.
+
+    The items are split into pages of params['number'] (default 10) items.
+    No requests are sent.
+    """
+    api = 'cache'
+    numParam = 'num'
+    Pages = CSEPages
+
+    title = 'Cached results - {0}'
+
+    def __init__(self, query, items, params=None, **kwargs):
+        params = dict(params or {})
+        super(CacheResults, self).__init__(query, params, **kwargs)
+        self['num'] = params.get('number') or 10
+        self.pages = self.Pages()
+        if items is not None:
+            self._load(items)
+
+    def _load(self, items):
+        number = self['num']
+        for start in range(0, len(items), number):
+            self.pages.append(self.Pages(self.pageData(self['q'],
+                items[start:start + number], start + 1, len(items))))
+        if not self.pages:
+            self.pages.append(self.Pages(self.pageData(self['q'], [], 1, 0)))
+        self.maxPages = len(self.pages)
+
+    @classmethod
+    def pageData(cls, query, items, startIndex, total):
+        """Return CSE response data holding items."""
+        return {'queries': {'request': [{'title': cls.title.format(query),
+            'startIndex': startIndex, 'count': len(items),
+            'totalResults': str(total)}]},
+            'items': [{'title': title, 'link': link, 'snippet': snippet}
+                for title, link, snippet in items]}
+
+    def pageStart(self, index):
+        return 1 + index * self['num']
+
+
+class Federated(CacheResults):
+    """Merged results of several engines searched concurrently.
+
+    The first next() calls next() of every engine in engines on its own
+    thread and waits at most timeout seconds for them, less if the deadline
+    leaves less time. The first pages that
+    arrived in time are merged by taking one item of each engine in turn, in
+    the order of engines, dropping links already taken (see normalizeURL).
+    The merged items are split into pages like CacheResults.
+
+    Engines that failed are listed in errors and those still running at the
+    deadline in late; their responses are still cached when they arrive.
+    The other engines are dropped once their items are merged.
+    SearchTimeoutError is raised if no engine answered in time, the error of
+    the first engine if all of them failed.
+    """
+    api = 'federated'
+    title = 'Merged results - {0}'
+
+    def __init__(self, query, engines, params=None, timeout=5.0, **kwargs):
+        super(Federated, self).__init__(query, None, params, **kwargs)
+        self.engines = list(engines)
+        self.timeout = timeout
+        self.errors = []
+        self.late = []
+
+    def next(self):
+        with self._lock:
+            if not self.pages:
+                try:
+                    self._load(self._merge(self._gather()))
+                finally:
+                    self.engines = []
+            return super(Federated, self).next()
+
+    def memoryUsage(self):
+        return super(Federated, self).memoryUsage() + sum(
+                engine.memoryUsage() for engine in self.engines + self.late)
+
+    def _gather(self):
+        """Return the first pages of the engines that answered in time, in
+        the order of engines."""
+        results = [None] * len(self.engines)
+
+        def search(index):
+            try:
+                results[index] = (self.engines[index].next(), None)
+            except Exception as e:
+                results[index] = (None, e)
+
+        timeout = self.timeout
+        if self.deadline is not None:
+            timeout = min(timeout, self.deadline.remaining())
+        deadline = clock() + timeout
+        threads = []
+        for index in range(len(self.engines)):
+            thread = threading.Thread(target=search, args=(index,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(deadline - clock(), 0))
+
+        pages = []
+        for engine, result in zip(self.engines, results):
+            if result is None:
+                self.late.append(engine)
+            elif result[1] is not None:
+                self.errors.append((engine, result[1]))
+            else:
+                pages.append(result[0])
+        self.metrics.incr('federated.late', len(self.late))
+        if not pages:
+            if self.late:
+                raise SearchTimeoutError('No search engine answered within'
+                        ' {0} seconds.'.format(timeout))
+            raise self.errors[0][1]
+        return pages
+
+    def _merge(self, pages):
+        """Return the raw items of pages interleaved, without repeated
+        links."""
+        items = []
+        for item in interleave([list(list.__iter__(page.items or []))
+                for page in pages]):
+            url = normalizeURL(item._raw[1])
+            if url not in self.seen:
+                self.seen.add(url)
+                items.append(item._raw)
+        return items
+
 # vim:set ts=4 sw=4 et tw=79:
@@ -0,0 +1,222 @@
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Asyncio engines.
+
+AsyncCSE and AsyncLegacy share the page and item model of CSE and Legacy
+but next() and previous() are coroutines, so many searches can run on one
+event loop. Requires Python 3 and the aiohttp package.
+"""
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .GoogleAPI import EngineBase, CSE, Legacy
+from .transport import HTTPResponse, Transport
+from .metrics import clock
+from .exceptions import QuotaExceededError, GoogleAPIError
+
+
+class AsyncHTTPResponse(HTTPResponse):
+    """Response of AsyncHTTPTransport. The body is read in full and decoded
+    on first use, so errors without a JSON body keep their status."""
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self._json = None
+
+
+class AsyncHTTPTransport(Transport):
+    """Keep-alive aiohttp session shared by all async engines. get() is a
+    coroutine.
+
+    The session is created on first use and belongs to the event loop that
+    was running at that time.
+    """
+    def __init__(self, poolSize=100, connectTimeout=5.0, readTimeout=10.0):
+        self._session = None
+        self.poolSize = poolSize
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            if aiohttp is None:
+                raise ImportError('Please install the aiohttp package')
+            connector = aiohttp.TCPConnector(limit=self.poolSize)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connectTimeout,
+                    sock_read=self.readTimeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                    timeout=timeout)
+        return self._session
+
+    async def get(self, url, params):
+        params = dict((k, str(v)) for k, v in params.items())
+        async with self.session.get(url, params=params) as response:
+            return AsyncHTTPResponse(response.status, await response.read())
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncSingleFlight(object):
+    """Coalesce concurrent coroutine calls sharing a key into one call."""
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, fn):
+        """Await fn() unless a call for key is already in progress, in which
+        case await that one. Returns (result, shared) like
+        SingleFlight.do()."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._calls.pop(key, None))
+        return (await asyncio.shield(task)), shared
+
+httpTransport = AsyncHTTPTransport()
+flight = AsyncSingleFlight()
+
+def asyncSearchEngine(engine, query, params, **kwargs):
+    if engine == 'cse':
+        cls = AsyncCSE
+    else:
+        cls = AsyncLegacy
+    return cls(query, params, **kwargs)
+
+
+class AsyncEngine(object):
+    """Coroutine versions of the EngineBase request methods.
+
+    Requests go through the shared AsyncHTTPTransport and AsyncSingleFlight
+    unless others are given as transport and flight. The transport's get()
+    must return an awaitable.
+    """
+    if aiohttp is not None:
+        networkErrors = (EnvironmentError, aiohttp.ClientError)
+
+    def __init__(self, query, params, **kwargs):
+        kwargs.setdefault('transport', httpTransport)
+        kwargs.setdefault('flight', flight)
+        super(AsyncEngine, self).__init__(query, params, **kwargs)
+        # Created on first use, in the event loop of the engine.
+        self._asyncLock = None
+
+    async def next(self):
+        if self._asyncLock is None:
+            self._asyncLock = asyncio.Lock()
+        async with self._asyncLock:
+            if not self.pages:
+                if self.prefetch and self.maxPages > 1:
+                    await self._prefetch()
+                else:
+                    await self._execute()
+                self.pages.next()
+            else:
+                if not self.pages.hasNext() and \
+                        self.maxPages > len(self.pages) and \
+                        self.maxPages != 0:
+                    self['start'] = self.pages.current.startIndex + \
+                        self.pages.current.count
+                    await self._execute()
+                self.pages.next()
+
+            return self.pages.current
+
+    async def previous(self):
+        return EngineBase.previous(self)
+
+    async def _fetch(self, params):
+        key = self.requestKey(params)
+        data = self._cached(key)
+        if data is not None:
+            return data
+        if self.deadline is None:
+            return await self._fetchData(key, params)
+        stale = self._cachedStale(key)
+        task = asyncio.ensure_future(self._fetchData(key, params))
+        try:
+            return await asyncio.wait_for(asyncio.shield(task),
+                    self._timeout(stale))
+        except asyncio.TimeoutError:
+            return self._missedDeadline(stale)
+
+    async def _fetchData(self, key, params):
+        try:
+            data, shared = await self.flight.do(key,
+                    lambda: self._send(params))
+        except GoogleAPIError as e:
+            self._storeError(key, e)
+            raise
+        if shared:
+            self.metrics.incr('flight.shared')
+        self._store(key, data, shared)
+        return data
+
+    async def _send(self, params):
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            try:
+                data = await self._requestData(params)
+            except (GoogleAPIError,) + self.networkErrors as e:
+                delay = self._failed(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return data
+
+    async def _requestData(self, params):
+        if self.limiter is not None:
+            try:
+                delay = self.limiter.reserve(params.get('key'), self.channel,
+                        self.channelQuota)
+            except QuotaExceededError:
+                self.metrics.incr('quota.refused')
+                raise
+            await asyncio.sleep(delay)
+        self.metrics.incr('requests')
+        start = clock()
+        response = await self.transport.get(self.url, params)
+        self.metrics.observe('http', clock() - start)
+        return self._decode(response)
+
+    async def _execute(self):
+        self.pages.append(self._parse(await self._fetch(self)))
+
+    async def _prefetch(self):
+        results = await asyncio.gather(*[self._fetch(params)
+            for params in self._prefetchBatch()], return_exceptions=True)
+        self._prefetched([(None, r) if isinstance(r, Exception) else (r, None)
+            for r in results])
+
+
+class AsyncLegacy(AsyncEngine, Legacy):
+    """Asyncio Legacy Search Engine."""
+
+
+class AsyncCSE(AsyncEngine, CSE):
+    """Asyncio Google Custom Search Engine."""
@@ -0,0 +1,241 @@
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Offline benchmarks for the parsing and navigation layer.
+
+Replays the sample*.json fixtures and synthetic 10 and 100 result responses
+through the page, item and navigation classes without any network access.
+Run from the plugin directory:
+
+    python -m local.bench            # report
+    python -m local.bench --save     # store the report as the baseline
+    python -m local.bench --check    # exit 1 on regressions
+
+Each case reports operations per second, memory blocks retained by one
+operation and its peak memory. Baselines are machine specific; save them on
+the machine the checks run on.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from .GoogleAPI import CSE, Legacy, CSEPages, LegacyPages, CSEItems
+from .transport import Response, Transport
+from .metrics import Metrics
+from .utils import SingleFlight, CircuitBreaker
+
+dir = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(dir, 'bench_baseline.json')
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def fixture(name):
+    with open(os.path.join(dir, name), 'r') as f:
+        return f.read()
+
+def synthetic(count, start=1):
+    """Return a CSE response body with count results from start."""
+    items = []
+    for i in range(start, start + count):
+        items.append({
+            'kind': 'customsearch#result',
+            'title': 'Result &amp; title {0} - <b>python</b> docs'.format(i),
+            'htmlTitle': 'Result &amp; title {0}'.format(i),
+            'link': 'https://example.com/docs/%7Epage{0}?q=python'.format(i),
+            'displayLink': 'example.com',
+            'snippet': 'Snippet {0} with &quot;quoted&quot; text\n'
+                'spanning lines.'.format(i),
+            'htmlSnippet': 'Snippet {0}'.format(i),
+            'pagemap': {'metatags': [{'og:title': 'Title {0}'.format(i),
+                'og:description': 'x' * 200}]},
+        })
+    return json.dumps({
+        'kind': 'customsearch#search',
+        'queries': {'request': [{'title': 'Google Custom Search - python',
+            'totalResults': '1000', 'searchTerms': 'python',
+            'count': count, 'startIndex': start}]},
+        'items': items,
+    })
+
+
+class BodyTransport(Transport):
+    """Decodes a new response for every request; body(params) returns the
+    response body."""
+    def __init__(self, body):
+        self.body = body
+
+    def get(self, url, params):
+        return Response(200, json.loads(self.body(params)))
+
+def session(cls, body, pages=1):
+    """Return an engine that fetched pages pages of body, like a search
+    session kept for navigation."""
+    engine = cls('python docs', {'number': 10, 'maxPages': pages},
+        api_key='bench', engine_id='bench', transport=BodyTransport(body),
+        flight=SingleFlight(), metrics=Metrics(), breaker=CircuitBreaker())
+    for i in range(pages):
+        engine.next()
+    return engine
+
+def navigate(page):
+    """Walk every item forwards then backwards, five at a time like the
+    plugin, reading the fields."""
+    items = page.items
+    window = items.window(5)
+    while window:
+        for item in window:
+            item.title, item.link, item.snippet
+        window = items.window(5)
+    while items.window(5, 'previous'):
+        pass
+
+def cases():
+    """Return {name: callable} of the benchmark cases."""
+    raw = {
+        'cse-p1': fixture('sampleResultsP1.json'),
+        'cse-p2': fixture('sampleResultsP2.json'),
+        'cse-synthetic-10': synthetic(10),
+        'cse-synthetic-100': synthetic(100),
+    }
+    legacy = fixture('sampleLegacyItems.json')
+    result = {}
+    for name, body in raw.items():
+        data = json.loads(body)
+        result['parse/' + name] = \
+            lambda body=body: CSEPages(json.loads(body))
+        result['items/' + name] = \
+            lambda data=data: CSEItems(items=data['items'])
+        result['navigate/' + name] = \
+            lambda body=body: navigate(CSEPages(json.loads(body)))
+    result['parse/legacy'] = lambda: LegacyPages(json.loads(legacy))
+    result['session/cse-synthetic-10x3'] = lambda: session(CSE,
+        lambda params: synthetic(10, params.get('start', 1)), 3)
+    result['session/legacy'] = lambda: session(Legacy, lambda params: legacy)
+    result['navigate/legacy'] = \
+        lambda: navigate(LegacyPages(json.loads(legacy)))
+    return result
+
+def timed(fn, number):
+    start = clock()
+    for i in range(number):
+        fn()
+    return clock() - start
+
+def rate(fn, minTime=0.2, repeat=5):
+    """Return operations per second of fn(), the best of repeat runs of at
+    least minTime / repeat seconds each."""
+    number = 1
+    while timed(fn, number) < minTime / repeat:
+        number *= 2
+    return number / min(timed(fn, number) for i in range(repeat))
+
+def memory(fn):
+    """Return (retained blocks, retained bytes, peak bytes) of one call to
+    fn(). Memory is retained if the result of fn() still refers to it."""
+    if tracemalloc is None:
+        return None, None, None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        base = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    size = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    del result
+    return blocks, size, peak
+
+def run(names=None, minTime=1.0):
+    report = {}
+    for name, fn in sorted(cases().items()):
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        blocks, size, peak = memory(fn)
+        report[name] = {'ops': rate(fn, minTime), 'blocks': blocks,
+            'bytes': size, 'peak': peak}
+    return report
+
+def compare(report, baseline, tolerance):
+    """Return a list of regressions of report against baseline."""
+    regressions = []
+    for name, result in sorted(report.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['ops'] < base['ops'] * (1 - tolerance):
+            regressions.append('{0}: {1:.0f} ops/s, baseline {2:.0f}'.format(
+                name, result['ops'], base['ops']))
+        for key in ('blocks', 'bytes', 'peak'):
+            if result.get(key) is not None and base.get(key) and \
+                    result[key] > base[key] * (1 + tolerance):
+                regressions.append('{0}: {1} {2}, baseline {3}'.format(name,
+                    result[key], key, base[key]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='GoogleCSE benchmarks.')
+    parser.add_argument('cases', nargs='*', help='case name prefixes')
+    parser.add_argument('--save', action='store_true',
+        help='store the results as the baseline')
+    parser.add_argument('--check', action='store_true',
+        help='exit with status 1 if a case regressed against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='allowed relative regression (default 0.25)')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--time', type=float, default=1.0,
+        help='minimum seconds to time each case')
+    args = parser.parse_args(argv)
+
+    report = run(args.cases, args.time)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.loads(f.read())
+    print('{0:<30} {1:>12} {2:>8} {3:>10} {4:>10} {5:>8}'.format('case',
+        'ops/s', 'blocks', 'bytes', 'peak', 'change'))
+    for name, result in sorted(report.items()):
+        change = ''
+        if name in baseline:
+            change = '{0:+.0%}'.format(result['ops'] /
+                baseline[name]['ops'] - 1)
+        print('{0:<30} {1:>12.0f} {2:>8} {3:>10} {4:>10} {5:>8}'.format(
+            name, result['ops'], result['blocks'], result.get('bytes'),
+            result['peak'], change))
+    if args.save:
+        baseline.update(report)
+        with open(args.baseline, 'w') as f:
+            f.write(json.dumps(baseline, indent=2, sort_keys=True))
+    if args.check:
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim:set ts=4 sw=4 et tw=79:
@@ -45,12 +45,27 @@ class _Exceptions(Exception):
 class GoogleAPIError(_Exceptions):
     def __init__(self, cls, response):
         _Exceptions.__init__(self)
-        json = response.json()
-        if cls.__name__ == 'CSE':
+        api = getattr(cls, 'api', None)
+        self.status = None
+        self.reason = None
+        try:
+            json = response.json()
+        except ValueError:
+            # Proxies and load balancers answer with HTML error pages.
+            json = None
+            api = None
+            self.status = response.status_code
+            self.template = '({0}) {1}: Undecodable response'
+            self.message = self.template.format(cls.__name__, self.status)
+        self.data = json
+        if api == 'cse':
+            self.status = json['error']['code']
+            self.reason = json['error']['errors'][0]['reason']
             self.template = '({0}) {1}: {2}: {3}'
             self.message = self.template.format(cls.__name__, json['error']['code'],
                 json['error']['message'], json['error']['errors'][0]['reason'])
-        elif cls.__name__ == 'Legacy':
+        elif api == 'legacy':
+            self.status = json['responseStatus']
             self.template = '({0}) {1}: {2}'
             self.message = self.template.format(cls.__name__, json['responseStatus'],
                 json['responseDetails'])
@@ -68,3 +83,21 @@ class APIError(Exception):
 class CSEAPIError(APIError):
     pass
 
+class QuotaExceededError(APIError):
+    pass
+
+class CassetteError(APIError):
+    pass
+
+class SearchTimeoutError(APIError):
+    pass
+
+class CircuitOpenError(APIError):
+    pass
+
+
+class PoolFullError(Exception):
+    def __init__(self, msg):
+        self.message = msg
+    def __str__(self):
+        return repr(self.message)
@@ -0,0 +1,170 @@
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Latency histograms and counters for the search phases.
+
+Phases timed by the engines are http (the request), decode (reading the JSON
+response) and parse (building pages and items); the plugin adds opts, format
+and reply. Counters track cache hits, quota refusals and similar events.
+"""
+import os
+import time
+import bisect
+import threading
+
+clock = getattr(time, 'perf_counter', time.time)
+replace = getattr(os, 'replace', os.rename)
+
+# Histogram bucket upper bounds in seconds, the last bucket is unbounded.
+BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Counts of observed durations in fixed logarithmic buckets."""
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the p-th (0-100)
+        percentile, or max for the unbounded bucket."""
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        total = 0
+        for index, n in enumerate(self.buckets):
+            total += n
+            if total >= rank and n:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                break
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'phase', 'start')
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.phase, clock() - self.start)
+        return False
+
+
+class Metrics(object):
+    """Latency histograms per phase and event counters.
+
+    Use "with metrics.timer('http'):" around a phase and
+    metrics.incr('cache.hit') to count events.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def timer(self, phase):
+        return _Timer(self, phase)
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.observe(seconds)
+
+    def percentile(self, phase, p):
+        """Return the p-th percentile of phase, 0 if it was not observed."""
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            return histogram.percentile(p) if histogram else 0.0
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """Return one line per phase and a line of counters."""
+        lines = []
+        with self._lock:
+            for phase, h in sorted(self.histograms.items()):
+                lines.append('{0}: {1} calls, p50 {2:.1f}ms, p95 {3:.1f}ms,'
+                    ' max {4:.1f}ms'.format(phase, h.count,
+                        h.percentile(50) * 1000, h.percentile(95) * 1000,
+                        h.max * 1000))
+            if self.counters:
+                lines.append(', '.join('{0}: {1}'.format(name, n)
+                    for name, n in sorted(self.counters.items())))
+        return lines
+
+    def text(self, prefix='googlecse'):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            name = prefix + '_phase_seconds'
+            if self.histograms:
+                lines.append('# TYPE {0} histogram'.format(name))
+            for phase, h in sorted(self.histograms.items()):
+                total = 0
+                for bound, n in zip(self._bounds(h), h.buckets):
+                    total += n
+                    lines.append('{0}_bucket{{phase="{1}",le="{2}"}} {3}'
+                        .format(name, phase, bound, total))
+                lines.append('{0}_sum{{phase="{1}"}} {2:.6f}'.format(name,
+                    phase, h.sum))
+                lines.append('{0}_count{{phase="{1}"}} {2}'.format(name,
+                    phase, h.count))
+            for counter, n in sorted(self.counters.items()):
+                metric = '{0}_{1}_total'.format(prefix,
+                    counter.replace('.', '_'))
+                lines.append('# TYPE {0} counter'.format(metric))
+                lines.append('{0} {1}'.format(metric, n))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _bounds(histogram):
+        return [repr(b) for b in histogram.bounds] + ['+Inf']
+
+    def write(self, path):
+        """Write text() to path, replacing the file atomically."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.text())
+        replace(tmp, path)
+
+metrics = Metrics()
@@ -1 +1,220 @@
-#query and connection classes/functions go here
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import time
+import threading
+
+from . import sql
+from .utils import loads
+
+
+class ResultCache(object):
+    """Persistent search response cache.
+
+    Responses are keyed by the engine request key (engine API, cx,
+    normalized query, start, num, safe, fields). Entries older than ttl seconds are
+    no longer returned by get() but kept for stale seconds more for
+    getStale(); the least recently accessed entries are evicted once
+    maxEntries is exceeded.
+
+    The result items stored with an entry are added to a full-text index
+    searched by search(), if SQLite supports FTS5.
+
+    Negative outcomes, responses without results and request errors, are
+    kept apart by setNegative() for emptyTtl and errorTtl seconds (0 to not
+    keep them).
+    """
+    def __init__(self, path, ttl=86400, maxEntries=1000, stale=0,
+            emptyTtl=3600, errorTtl=600):
+        self.ttl = ttl
+        self.stale = stale
+        self.emptyTtl = emptyTtl
+        self.errorTtl = errorTtl
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        self.db = sql.connect(path)
+        self.indexed = sql.hasTable(self.db, 'result_index')
+
+    @staticmethod
+    def key(requestKey):
+        return json.dumps(list(requestKey))
+
+    def get(self, requestKey):
+        """Return the cached response data for requestKey or None."""
+        key = self.key(requestKey)
+        now = time.time()
+        with self._lock:
+            row = self.db.execute('SELECT id, response, created FROM results'
+                    ' WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            with self.db:
+                if row['created'] + self.ttl < now:
+                    if row['created'] + self.ttl + self.stale < now:
+                        self.db.execute('DELETE FROM results WHERE id = ?',
+                                (row['id'],))
+                    return None
+                self.db.execute('UPDATE results SET accessed = ?,'
+                        ' hits = hits + 1 WHERE id = ?', (now, row['id']))
+        return loads(row['response'])
+
+    def getStale(self, requestKey):
+        """Return the cached response data for requestKey, expired or not,
+        or None. Hits are not counted."""
+        with self._lock:
+            row = self.db.execute('SELECT response FROM results WHERE key = ?'
+                    ' AND created >= ?', (self.key(requestKey),
+                        time.time() - self.ttl - self.stale)).fetchone()
+        if row is None:
+            return None
+        return loads(row['response'])
+
+    def set(self, requestKey, data, items=(), original=None,
+            refreshed=False):
+        """Store response data for requestKey and index its raw (title,
+        link, snippet) items. original is the query as it was sent, before
+        normalization. The hit count of a replaced entry is kept, unless the
+        entry is refreshed: a refresh is not a use, so the hit count starts
+        again at zero and the access time is kept."""
+        engine, cx, q, start, num, safe, fields = requestKey
+        key = self.key(requestKey)
+        now = time.time()
+        with self._lock:
+            with self.db:
+                row = self.db.execute('SELECT accessed, hits FROM results'
+                        ' WHERE key = ?', (key,)).fetchone()
+                accessed, hits = now, 0
+                if row is not None:
+                    if refreshed:
+                        accessed = row['accessed']
+                    else:
+                        hits = row['hits']
+                cursor = self.db.execute('INSERT OR REPLACE INTO results (key,'
+                    ' engine, cx, q, original, start, num, safe, fields,'
+                    ' response, created, accessed, hits) VALUES (?, ?, ?, ?,'
+                    ' ?, ?, ?, ?, ?, ?, ?, ?, ?)', (key, engine, cx, q,
+                        original, start, num, safe, fields, json.dumps(data),
+                        now, accessed, hits))
+                if self.indexed and items:
+                    self._index(cursor.lastrowid, q, items)
+                self.db.execute('DELETE FROM negative WHERE key = ?', (key,))
+                self._evict(now)
+
+    def getNegative(self, requestKey):
+        """Return the (status, response data) of the negative outcome kept
+        for requestKey or None."""
+        now = time.time()
+        with self._lock:
+            row = self.db.execute('SELECT status, response FROM negative'
+                    ' WHERE key = ? AND created >= CASE status WHEN 200 THEN'
+                    ' ? ELSE ? END', (self.key(requestKey),
+                        now - self.emptyTtl, now - self.errorTtl)).fetchone()
+        if row is None:
+            return None
+        return row['status'], loads(row['response'])
+
+    def setNegative(self, requestKey, data, status=200):
+        """Keep the response data of a request without results (status 200)
+        or failed with status."""
+        if not (self.emptyTtl if status == 200 else self.errorTtl):
+            return
+        now = time.time()
+        with self._lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO negative (key, status,'
+                    ' response, created) VALUES (?, ?, ?, ?)',
+                    (self.key(requestKey), status, json.dumps(data), now))
+                self.db.execute('DELETE FROM negative WHERE created < CASE'
+                    ' status WHEN 200 THEN ? ELSE ? END', (now - self.emptyTtl,
+                        now - self.errorTtl))
+                self.db.execute('DELETE FROM negative WHERE key NOT IN (SELECT'
+                    ' key FROM negative ORDER BY created DESC LIMIT ?)',
+                    (self.maxEntries,))
+
+    def _index(self, id, q, items):
+        self.db.executemany('INSERT INTO result_index (rowid, title, snippet,'
+            ' link, q) VALUES (?, ?, ?, ?, ?)', [(id * sql.ITEMS + position,
+                title, snippet, link, q) for position, (title, link, snippet)
+                in enumerate(items[:sql.ITEMS])])
+
+    def search(self, query, limit=10):
+        """Return up to limit raw (title, link, snippet) items of unexpired
+        entries matching every word of query, best match first. Items are
+        unique by link."""
+        terms = ['"{0}"'.format(term.replace('"', '""'))
+                for term in query.split()]
+        if not self.indexed or not terms:
+            return []
+        with self._lock:
+            rows = self.db.execute('SELECT result_index.title,'
+                ' result_index.link, result_index.snippet FROM result_index'
+                ' JOIN results ON results.id = result_index.rowid / ?'
+                ' WHERE result_index MATCH ? AND results.created >= ?'
+                ' ORDER BY result_index.rank LIMIT ?', (sql.ITEMS,
+                    ' '.join(terms), time.time() - self.ttl,
+                    limit * 2)).fetchall()
+        items, links = [], set()
+        for title, link, snippet in rows:
+            if link not in links and len(items) < limit:
+                links.add(link)
+                items.append((title, link, snippet))
+        return items
+
+    def _evict(self, now):
+        self.db.execute('DELETE FROM results WHERE created < ?',
+                (now - self.ttl - self.stale,))
+        self.db.execute('DELETE FROM results WHERE id NOT IN (SELECT id FROM'
+                ' results ORDER BY accessed DESC LIMIT ?)', (self.maxEntries,))
+
+    def contains(self, requestKey):
+        with self._lock:
+            row = self.db.execute('SELECT 1 FROM results WHERE key = ?',
+                    (self.key(requestKey),)).fetchone()
+        return row is not None
+
+    def expiring(self, within, minHits=1, limit=10):
+        """Return up to limit rows of entries with at least minHits hits
+        since they were stored or refreshed, expiring in the next within seconds, most hit first. original is the
+        query as it was sent, q for entries stored without it."""
+        now = time.time()
+        with self._lock:
+            return self.db.execute('SELECT id, engine, cx, q,'
+                ' COALESCE(original, q) AS original, start, num, safe,'
+                ' fields, hits FROM results WHERE created + ? BETWEEN ? AND ?'
+                ' AND hits >= ? ORDER BY hits DESC LIMIT ?', (self.ttl, now,
+                    now + within, minHits, limit)).fetchall()
+
+    def list(self):
+        """Return (id, engine, q, original, start, hits) rows, most recent
+        first."""
+        with self._lock:
+            return self.db.execute('SELECT id, engine, q, COALESCE(original,'
+                    ' q) AS original, start, hits FROM results ORDER BY'
+                    ' accessed DESC').fetchall()
+
+    def remove(self, id):
+        """Remove entry id. Returns True if an entry was removed."""
+        with self._lock:
+            with self.db:
+                cursor = self.db.execute('DELETE FROM results WHERE id = ?',
+                        (id,))
+        return cursor.rowcount > 0
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,171 @@
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import hashlib
+import datetime
+import threading
+
+from . import sql
+from .exceptions import QuotaExceededError
+from .utils import TokenBucket
+
+try:
+    from zoneinfo import ZoneInfo
+    PACIFIC = ZoneInfo('America/Los_Angeles')
+except Exception:
+    PACIFIC = None
+
+DAY = 86400.0
+# Used when the zone database is missing: Pacific Standard Time.
+PACIFIC_OFFSET = -8 * 3600
+
+
+def quotaDay(now=None):
+    """Return the number of the quota day at now. Google resets the daily
+    quota at midnight Pacific time."""
+    now = time.time() if now is None else now
+    if PACIFIC is not None:
+        return datetime.datetime.fromtimestamp(now, PACIFIC).toordinal()
+    return int((now + PACIFIC_OFFSET) // DAY)
+
+
+class DailyCounter(object):
+    """Requests counted against capacity in one quota day. The count starts
+    again at zero when the day changes."""
+    def __init__(self, capacity, used=0, day=None):
+        self.capacity = capacity
+        self.used = used
+        self.day = day
+
+    def remaining(self, now=None):
+        day = quotaDay(now)
+        if day != self.day:
+            self.day = day
+            self.used = 0
+        return max(self.capacity - self.used, 0)
+
+    def take(self, n=1):
+        self.used += n
+
+
+class RateLimiter(object):
+    """Request quota per API key and channel.
+
+    Every API key has a budget of daily requests per quota day, which ends at
+    midnight Pacific time like Google's own quota, and a bucket of perSecond
+    requests refilled every second. A channel may be given its own daily
+    budget, drawn from the key's quota. Requests are refused once a daily
+    budget is used up; when the per second rate is exceeded they wait up to
+    maxWait seconds for their turn. Daily counts are stored in the database
+    at path, if given.
+    """
+    def __init__(self, path=None, daily=100, perSecond=10, maxWait=2.0):
+        self.daily = daily
+        self.perSecond = perSecond
+        self.maxWait = maxWait
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._counters = {}
+        self._saved = {}
+        self.db = None
+        if path is not None:
+            self.db = sql.connect(path)
+            for row in self.db.execute('SELECT name, used, day FROM quota'):
+                self._saved[row['name']] = (row['used'], row['day'])
+
+    @staticmethod
+    def keyName(apikey):
+        """Return the bucket name for apikey without exposing the key."""
+        if not apikey:
+            return 'legacy'
+        return 'key:' + hashlib.sha1(apikey.encode('utf-8')).hexdigest()[:8]
+
+    def _bucket(self, name, capacity, rate):
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self._buckets[name] = TokenBucket(capacity, rate)
+        bucket.capacity = capacity
+        bucket.rate = rate
+        bucket.tokens = min(bucket.tokens, capacity)
+        return bucket
+
+    def _counter(self, name, capacity):
+        counter = self._counters.get(name)
+        if counter is None:
+            used, day = self._saved.pop(name, (0, None))
+            counter = self._counters[name] = DailyCounter(capacity, used, day)
+        counter.capacity = capacity
+        return counter
+
+    def _dailyCounters(self, apikey, channel, channelDaily):
+        name = self.keyName(apikey)
+        counters = [(name, self._counter(name, self.daily))]
+        if channel and channelDaily:
+            name = '{0}:{1}'.format(name, channel.lower())
+            counters.append((name, self._counter(name, channelDaily)))
+        return counters
+
+    def reserve(self, apikey, channel=None, channelDaily=0, now=None):
+        """Take the quota for one request and return the number of seconds
+        to wait before sending it. Raises QuotaExceededError if a daily
+        budget is used up or the wait would exceed maxWait."""
+        now = time.time() if now is None else now
+        with self._lock:
+            daily = self._dailyCounters(apikey, channel, channelDaily)
+            for index, (name, counter) in enumerate(daily):
+                if counter.remaining(now) < 1:
+                    if index > 0:
+                        raise QuotaExceededError('Daily search quota for'
+                            ' this channel exhausted.')
+                    raise QuotaExceededError('Daily search quota exhausted.')
+            second = self._bucket(self.keyName(apikey) + ':second',
+                    self.perSecond, self.perSecond)
+            delay = second.delay(1, now)
+            if delay > self.maxWait:
+                raise QuotaExceededError('Too many searches, try again'
+                        ' later.')
+            second.take()
+            for name, counter in daily:
+                counter.take()
+            self._save(daily)
+        return delay
+
+    def acquire(self, apikey, channel=None, channelDaily=0):
+        """Like reserve() but wait until the request may be sent."""
+        delay = self.reserve(apikey, channel, channelDaily)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _save(self, counters):
+        if self.db is None:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO quota (name, used,'
+                ' day) VALUES (?, ?, ?)', [(name, counter.used,
+                    counter.day) for name, counter in counters])
+
+    def status(self, apikey, channel=None, channelDaily=0, now=None):
+        """Return (name, remaining, capacity) for the daily budgets of apikey
+        and channel."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return [(name, int(counter.remaining(now)), counter.capacity)
+                for name, counter in self._dailyCounters(apikey, channel,
+                    channelDaily)]
+
+    def close(self):
+        with self._lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,80 @@
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import threading
+
+from .exceptions import QuotaExceededError
+
+
+class CacheRefresher(object):
+    """Re-fetch popular cached responses shortly before they expire.
+
+    Every interval seconds (0 disables refreshing) the entries of cache with
+    at least minHits hits that expire within margin seconds are fetched
+    again, most hit first. A pass sends at most share of the remaining daily
+    quota in requests.
+    """
+    def __init__(self, cache, interval=300, margin=900, minHits=2,
+            share=0.1):
+        self.cache = cache
+        self.interval = interval
+        self.margin = margin
+        self.minHits = minHits
+        self.share = share
+        self.last = time.time()
+        self.running = False
+        self._lock = threading.Lock()
+
+    def due(self, now=None):
+        """Return True, and start a pass, if one is due."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self.running or not self.interval or \
+                    now - self.last < self.interval:
+                return False
+            self.last = now
+            self.running = True
+            return True
+
+    def done(self):
+        """End the pass started by due()."""
+        with self._lock:
+            self.running = False
+
+    def refresh(self, fetch, remaining, errback=None):
+        """Call fetch(row) for the entries to refresh, using at most share of
+        remaining requests. Errors are passed to errback(row, e); the pass
+        stops when the quota is exhausted. Returns the number of entries
+        refreshed."""
+        try:
+            budget = int(remaining * self.share)
+            if budget <= 0:
+                return 0
+            count = 0
+            for row in self.cache.expiring(self.margin, self.minHits, budget):
+                try:
+                    fetch(row)
+                except QuotaExceededError as e:
+                    if errback is not None:
+                        errback(row, e)
+                    break
+                except Exception as e:
+                    if errback is not None:
+                        errback(row, e)
+                    continue
+                count += 1
+            return count
+        finally:
+            self.done()
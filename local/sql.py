@@ -1 +1,93 @@
-#low level database schema goes here
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sqlite3
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE NOT NULL,
+        engine TEXT NOT NULL,
+        cx TEXT,
+        q TEXT NOT NULL,
+        original TEXT,
+        start INTEGER,
+        num INTEGER,
+        safe TEXT,
+        fields TEXT,
+        response TEXT NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)""",
+    """CREATE TABLE IF NOT EXISTS negative (
+        key TEXT PRIMARY KEY,
+        status INTEGER NOT NULL,
+        response TEXT NOT NULL,
+        created REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS quota (
+        name TEXT PRIMARY KEY,
+        used INTEGER NOT NULL,
+        day INTEGER NOT NULL
+    )""",
+)
+
+# Full-text index of the cached result items, created when SQLite has FTS5.
+# The rowid of an item is the result id * ITEMS + its position on the page.
+ITEMS = 100
+INDEX_SCHEMA = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS result_index USING fts5 (
+        title, snippet, link, q
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS results_unindex AFTER DELETE ON results
+    BEGIN
+        DELETE FROM result_index WHERE rowid BETWEEN old.id * {0}
+            AND old.id * {0} + {1};
+    END""".format(ITEMS, ITEMS - 1),
+)
+
+# (table, column, definition) added to databases created before the column.
+COLUMNS = (
+    ('results', 'fields', 'TEXT'),
+    ('results', 'original', 'TEXT'),
+)
+
+def connect(path):
+    """Open the database at path and create any missing tables and
+    columns."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # Fire the delete triggers for rows replaced by INSERT OR REPLACE.
+    conn.execute('PRAGMA recursive_triggers = ON')
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        for table, column, definition in COLUMNS:
+            names = [row['name'] for row in
+                conn.execute('PRAGMA table_info({0})'.format(table))]
+            if column not in names:
+                conn.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                    table, column, definition))
+    try:
+        with conn:
+            for statement in INDEX_SCHEMA:
+                conn.execute(statement)
+    except sqlite3.OperationalError:
+        pass
+    return conn
+
+def hasTable(conn, name):
+    return conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?',
+            (name,)).fetchone() is not None
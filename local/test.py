@@ -1,7 +1,30 @@
+import os
 import sys
+import time
+import tempfile
+import threading
 import unittest
 import json
-from .GoogleAPI import CSE, Legacy
+import sqlite3
+from .GoogleAPI import (CSE, Legacy, CSEItem, CacheResults, Federated,
+        CSEPages, CSEItems, LegacyPages, PageInfo)
+from .transport import (Transport, HTTPTransport, HTTPResponse,
+        StaticTransport, RecordTransport, ReplayTransport)
+from .queries import ResultCache
+from .refresh import CacheRefresher
+from .workers import WorkerPool
+from .utils import (SingleFlight, TokenBucket, SessionStore, normalizeQuery,
+        normalizeURL, interleave, Deadline, CircuitBreaker)
+from .quota import RateLimiter, quotaDay
+from . import sql
+from .metrics import Metrics, Histogram
+from . import bench
+if sys.version_info[0] >= 3:
+    import asyncio
+    from .aio import (AsyncCSE, AsyncLegacy, AsyncSingleFlight,
+            AsyncHTTPTransport, aiohttp)
+else:
+    aiohttp = None
 from .exceptions import *
 
 def recode(s):
@@ -10,6 +33,16 @@ def recode(s):
     return s
 
 
+def isolated(**kwargs):
+    """Return engine keyword arguments with a circuit breaker, single flight
+    and metrics of their own and a short retry backoff."""
+    kwargs.setdefault('breaker', CircuitBreaker())
+    kwargs.setdefault('flight', SingleFlight())
+    kwargs.setdefault('metrics', Metrics())
+    kwargs.setdefault('backoff', 0.001)
+    return kwargs
+
+
 class DResponse(object):
     def __init__(self, data):
         self._json = data
@@ -17,52 +50,87 @@ class DResponse(object):
         return self._json
 
 
+def feed(data, status_code=200):
+    """Return a transport answering every request with data."""
+    response = DResponse(data)
+    response.status_code = status_code
+    return StaticTransport(response)
+
+
+class DTransport(Transport):
+    """Transport serving response data by start parameter."""
+    def __init__(self, pages, gate=None):
+        self.pages = pages
+        self.gate = gate
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def get(self, url, params):
+        with self._lock:
+            self.requests.append((url, dict(params)))
+        if self.gate is not None:
+            self.gate.wait()
+        response = DResponse(self.pages[params.get('start')])
+        response.status_code = 200
+        return response
+
+
 class TestCSE(unittest.TestCase):
     def setUp(self):
         q = 'python docs'
         opts = {'number': 1} 
-        self.engine = CSE(q, opts, api_key='testkey', engine_id='TestEngine')
+        self.engine = CSE(q, opts, api_key='testkey', engine_id='TestEngine',
+                **isolated())
 
     def testGoogleAPIErrors(self):
         with open('sample400Error.json', 'r') as f:
             j = json.loads(f.read())
                
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j[0])
-        self.engine.response.status_code = \
-                self.engine.response._json['error']['code']
+        self.engine.transport = feed(j[0], j[0]['error']['code'])
         self.assertRaisesRegexp(GoogleAPIError, '\(CSE\) 400:.*: keyInvalid',
                 self.engine.next)
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j[1])
-        self.engine.response.status_code = \
-                self.engine.response._json['error']['code']
+        self.engine.transport = feed(j[1], j[1]['error']['code'])
         self.assertRaisesRegexp(GoogleAPIError, '\(CSE\) 400:.*$',
                 self.engine.next)
         
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j[2])
-        self.engine.response.status_code = \
-                self.engine.response._json['error']['code']
+        self.engine.transport = feed(j[2], j[2]['error']['code'])
         self.assertRaisesRegexp(GoogleAPIError, '\(CSE\) 500:.*$',
                 self.engine.next)
 
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j[3])
-        self.engine.response.status_code = \
-                self.engine.response._json['error']['code']
+        self.engine.transport = feed(j[3], j[3]['error']['code'])
         self.assertRaisesRegexp(GoogleAPIError, '\(CSE\) 403:.*',
                 self.engine.next)
 
+    def testIngest(self):
+        with open('sampleLegacyItems.json') as f:
+            data = json.loads(f.read())
+        info, results = LegacyPages.ingest(data)
+        self.assertEqual(info, PageInfo('Legacy API Search Results', 0,
+            len(results), 3100000))
+        with open('sampleResultsP2.json') as f:
+            data = json.loads(f.read())
+        page = CSEPages(data)
+        request = data['queries']['request'][0]
+        self.assertEqual(page.info, PageInfo(request['title'],
+            request['startIndex'], request['count'],
+            int(request['totalResults'])))
+        self.assertEqual(page.data['startIndex'], request['startIndex'])
+        # Only the metadata and the item strings are kept.
+        self.assertEqual(sorted(vars(page)), ['_current_index', 'info',
+            'items', 'parent'])
+        for item in list.__iter__(page.items):
+            self.assertFalse([v for v in item._raw if isinstance(v, dict)])
+        with open('sampleNoResults.json') as f:
+            self.assertEqual(CSEPages.ingest(json.loads(f.read()))[0].count,
+                    0)
+
     def testCSENoResults(self):
         self.engine = CSE('python docs', {'number': 1}, api_key='testkey', 
-                engine_id='TestEngine')
+                engine_id='TestEngine', **isolated())
         with open('sampleNoResults.json', 'r') as f:
             j = json.loads(f.read())
 
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j)
-        self.engine.response.status_code = 200
+        self.engine.transport = feed(j)
         page = self.engine.next()
         self.assertEqual(page.count, 0)
 
@@ -71,11 +139,7 @@ class TestCSE(unittest.TestCase):
         with open('sampleResultsP1.json') as f:
             j = json.loads(f.read())
         
-        def feed():
-            self.engine._test_feed = True
-            self.engine.response = DResponse(j)
-            self.engine.response.status_code = 200
-        feed()
+        self.engine.transport = feed(j)
         page = self.engine.next()
         self.assertEqual(page.title, 
                 recode('Google Custom Search - python docs'))
@@ -85,15 +149,18 @@ class TestCSE(unittest.TestCase):
         with open('sampleResultsP2.json') as f:
             j = json.loads(f.read())
 
-        feed()
+        self.engine.transport = feed(j)
         self.engine.next()
         self.assertEqual(len(self.engine.pages), 2)
         self.assertEqual(self.engine.currentPage.startIndex, 11)
         self.engine.previous()
         self.assertEqual(self.engine.currentPage.startIndex, 1)
         self.engine.next()
+        self.assertFalse(self.engine.hasNext())
         self.assertRaises(IndexError, self.engine.next)
         self.engine.previous()
+        self.assertTrue(self.engine.hasNext())
+        self.assertFalse(self.engine.hasPrevious())
         self.assertRaises(IndexError, self.engine.previous)
         self.assertEqual(self.engine.currentPage.startIndex, 1)
 
@@ -122,15 +189,62 @@ class TestCSE(unittest.TestCase):
         self.assertRegexpMatches(item.title,
             recode('Overview.*Python.*documentation'))
 
+    def testItems(self):
+        with open('sampleResultsP1.json') as f:
+            j = json.loads(f.read())
+        self.engine.transport = feed(j)
+        items = self.engine.next().items
+        item = items[0]
+        self.assertTrue(isinstance(item, CSEItem))
+        self.assertFalse(hasattr(item, '__dict__'))
+        self.assertTrue(item.title is item.title)
+        self.assertEqual(item.link, j['items'][0]['link'])
+        self.assertEqual(item.snippet, items.next().snippet)
+        self.assertEqual(len(items[1:3]), 2)
+        calls = []
+        def render(item):
+            calls.append(item)
+            return item.title
+        self.assertEqual(item.rendered('a', render), item.title)
+        self.assertEqual(item.rendered('a', render), item.title)
+        item.rendered('b', render)
+        self.assertEqual(len(calls), 2)
+
+    def testNormalizeURL(self):
+        for url in ('HTTP://Docs.Python.org:80/3/', 'http://docs.python.org/3',
+                'http://docs.python.org/3/?utm_source=x&utm_medium=y#intro'):
+            self.assertEqual(normalizeURL(url), 'http://docs.python.org/3')
+        self.assertEqual(normalizeURL('https://a.org/p?id=1&gclid=2&b=3'),
+                'https://a.org/p?id=1&b=3')
+        self.assertNotEqual(normalizeURL('https://a.org/P'),
+                normalizeURL('https://a.org/p'))
+
+    def testDeduplicate(self):
+        with open('sampleResultsP1.json') as f:
+            p1 = json.loads(f.read())
+        with open('sampleResultsP2.json') as f:
+            p2 = json.loads(f.read())
+        p2['items'][0]['link'] = p1['items'][0]['link'].upper().replace(
+                'HTTPS', 'https') + '/'
+        p2['items'][1]['link'] = p1['items'][1]['link'] + '?utm_source=g'
+        engine = CSE('python docs', {'number': 10, 'maxPages': 2},
+                api_key='testkey', engine_id='TestEngine',
+                transport=DTransport({None: p1, 11: p2}), **isolated())
+        self.assertEqual(len(engine.next().items), 10)
+        page = engine.next()
+        self.assertEqual(page.count, 10)
+        links = [item.link for item in list.__iter__(page.items)]
+        self.assertTrue(p2['items'][1]['link'] not in links)
+        self.assertTrue(len(links) in (8, 9))
+        self.assertEqual(len(engine.seen), 10 + len(links))
+
     def testLegacyErrors(self):
         with open('sampleLegacyError.json', 'r') as f:
             j = json.loads(f.read())
         q = 'python docs'
         opts={'start': 0}
-        self.engine = Legacy(q, opts)
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j)
-        self.engine.response.status_code = 200
+        self.engine = Legacy(q, opts, **isolated())
+        self.engine.transport = feed(j)
         self.assertRaisesRegexp(GoogleAPIError, '\(Legacy\)\s400:\sinvalid\s'
                 'resultSize', self.engine.next)
 
@@ -139,10 +253,8 @@ class TestCSE(unittest.TestCase):
             j = json.loads(f.read())
         q = 'python docs'
         opts={'start': 0}
-        self.engine = Legacy(q, opts)
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j)
-        self.engine.response.status_code = 200
+        self.engine = Legacy(q, opts, **isolated())
+        self.engine.transport = feed(j)
         self.engine.next()
 
     def testLegacyItems(self):
@@ -150,10 +262,8 @@ class TestCSE(unittest.TestCase):
             j = json.loads(f.read())
         q = 'python docs'
         opts={'start': 0}
-        self.engine = Legacy(q, opts)
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j)
-        self.engine.response.status_code = 200
+        self.engine = Legacy(q, opts, **isolated())
+        self.engine.transport = feed(j)
         self.engine.next()
         page = self.engine.currentPage
         item = page.nextItem()
@@ -171,12 +281,10 @@ class TestCSE(unittest.TestCase):
         self.assertRaises(IndexError, self.engine.next)
     
     def testLegacyNoResults(self):
-        self.engine = Legacy('', {})
+        self.engine = Legacy('', {}, **isolated())
         with open('sampleLegacyNoResults.json', 'r') as f:
             j = json.loads(f.read())
-        self.engine._test_feed = True
-        self.engine.response = DResponse(j)
-        self.engine.response.status_code = 200
+        self.engine.transport = feed(j)
         page = self.engine.next()
         self.assertEqual(page.count, 0)
 
@@ -184,7 +292,7 @@ class TestCSE(unittest.TestCase):
     def testLegacyRealRequests(self):
         """No rate limits on real requests."""
         q = 'python docs'
-        self.engine = Legacy(q, {})
+        self.engine = Legacy(q, {}, **isolated())
         self.engine.next()
         page = self.engine.currentPage
         item = page.nextItem()
@@ -206,4 +314,1085 @@ class TestCSE(unittest.TestCase):
         self.assertEqual(page.startIndex, 4)
         page = self.engine.previous()
 
+
+class TestItemIndexTree(unittest.TestCase):
+    def setUp(self):
+        with open('sampleResultsP1.json') as f:
+            self.items = CSEItems(items=json.loads(f.read())['items'])
+        self.all = list(list.__iter__(self.items))
+
+    def testWindow(self):
+        items = self.items
+        self.assertFalse(items.hasPrevious())
+        self.assertEqual(items.window(3, 'previous'), [])
+        self.assertEqual(items.window(4), self.all[:4])
+        self.assertEqual(items.current, self.all[3])
+        self.assertEqual(items.window(4), self.all[4:8])
+        self.assertEqual(items.window(4), self.all[8:])
+        self.assertEqual(items.window(4), [])
+        self.assertFalse(items.hasNext())
+        self.assertEqual(items.window(4, 'previous'), self.all[5:9])
+        self.assertEqual(items.current, self.all[5])
+        self.assertEqual(items.window(10, 'previous'), self.all[:5])
+        self.assertEqual(items.window(1, 'previous'), [])
+        self.assertEqual(items.window(1), [self.all[1]])
+
+    def testCursor(self):
+        items = self.items
+        self.assertRaises(IndexError, items.previous)
+        self.assertEqual(items.next(), self.all[0])
+        self.assertTrue(items[1] is self.all[1])
+        for i in range(len(self.all) - 1):
+            items.next()
+        self.assertRaises(IndexError, items.next)
+        self.assertEqual(items.previous(), self.all[-2])
+        self.assertEqual(CSEItems().window(5), [])
+        self.assertEqual(CSEPages().itemWindow(5), [])
+
+
+class TestTransport(unittest.TestCase):
+    def testSession(self):
+        transport = HTTPTransport(poolSize=2, connectTimeout=1, readTimeout=2)
+        session = transport.session
+        self.assertTrue(transport.session is session)
+        self.assertEqual(transport.timeout, (1, 2))
+        transport.configure(readTimeout=3)
+        self.assertTrue(transport.session is session)
+        self.assertEqual(transport.timeout, (1, 3))
+        transport.configure(poolSize=4)
+        self.assertFalse(transport.session is session)
+        transport.close()
+
+    def testEngineTransport(self):
+        with open('sampleResultsP1.json') as f:
+            transport = DTransport({None: json.loads(f.read())})
+        engine = CSE('python docs', {}, api_key='testkey',
+                engine_id='TestEngine', transport=transport, **isolated())
+        engine.next()
+        self.assertEqual(len(transport.requests), 1)
+        self.assertEqual(transport.requests[0][0], CSE.url)
+        self.assertEqual(transport.requests[0][1]['q'], 'python docs')
+
+    def testPrefetch(self):
+        pages = {}
+        for start, name in ((None, 'sampleResultsP1.json'),
+                (11, 'sampleResultsP2.json'), (21, 'sampleNoResults.json')):
+            with open(name) as f:
+                pages[start] = json.loads(f.read())
+        transport = DTransport(pages)
+        engine = CSE('python docs', {'number': 10, 'maxPages': 3},
+                api_key='testkey', engine_id='TestEngine',
+                transport=transport, prefetch=True, **isolated())
+        page = engine.next()
+        self.assertEqual(len(transport.requests), 3)
+        self.assertEqual(page.startIndex, 1)
+        self.assertEqual(len(engine.pages), 2)
+        self.assertEqual(engine.maxPages, 2)
+        self.assertEqual(engine.next().startIndex, 11)
+        self.assertRaises(IndexError, engine.next)
+        self.assertEqual(len(transport.requests), 3)
+        self.assertEqual(engine.previous().startIndex, 1)
+
+    def testConcurrentNext(self):
+        with open('sampleResultsP1.json') as f:
+            p1 = json.loads(f.read())
+        with open('sampleResultsP2.json') as f:
+            p2 = json.loads(f.read())
+        gate = threading.Event()
+        transport = DTransport({None: p1, 11: p2, 21: p2}, gate)
+        engine = CSE('python docs', {'number': 10, 'maxPages': 3},
+                api_key='testkey', engine_id='TestEngine',
+                transport=transport, **isolated())
+        gate.set()
+        engine.next()
+        gate.clear()
+        threads = [threading.Thread(target=engine.next) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        while len(transport.requests) < 2:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([params.get('start') for url, params in
+            transport.requests], [None, 11, 21])
+        self.assertEqual(len(engine.pages), 3)
+        self.assertRaises(IndexError, engine.next)
+        engine.previous()
+        engine.previous()
+        engine.next()
+        self.assertEqual(len(transport.requests), 3)
+
+    def testSingleFlight(self):
+        with open('sampleResultsP1.json') as f:
+            gate = threading.Event()
+            transport = DTransport({None: json.loads(f.read())}, gate)
+        flight = SingleFlight()
+        engines = [CSE('python docs', {}, api_key='testkey',
+            engine_id='TestEngine', transport=transport,
+            **isolated(flight=flight))
+            for i in range(3)]
+        threads = [threading.Thread(target=engine.next)
+                for engine in engines]
+        for thread in threads:
+            thread.start()
+        while len(transport.requests) < 1 or len(flight) < 1:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(transport.requests), 1)
+        self.assertEqual(len(flight), 0)
+        for engine in engines:
+            self.assertEqual(len(engine.currentPage.items), 10)
+
+    def testSingleFlightError(self):
+        flight = SingleFlight()
+        def fail():
+            raise ValueError('failed')
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        self.assertEqual(flight.do('key', lambda: 1), (1, False))
+
+    def testFields(self):
+        with open('sampleResultsP1.json') as f:
+            transport = feed(json.loads(f.read()))
+        engines = [CSE('python docs', params, api_key='testkey',
+            engine_id='TestEngine', transport=transport, **isolated())
+            for params in ({}, {'snippet': False}, {'fields': ''})]
+        for engine in engines:
+            engine.next()
+        fields = [params.get('fields') for url, params in transport.requests]
+        self.assertEqual(fields, [CSE.partialFields(),
+            CSE.partialFields(False), None])
+        self.assertTrue(fields[0].endswith('items(title,link,snippet)'))
+        self.assertEqual(len(set(engine.requestKey() for engine in engines)),
+                3)
+
+    def testHTTPResponse(self):
+        class Raw(object):
+            status_code = 200
+            content = b'{"a": [1, 2]}'
+        response = HTTPResponse(Raw())
+        self.assertEqual(response.json(), {'a': [1, 2]})
+        self.assertTrue(response.json() is response.json())
+
+    def testRecordReplay(self):
+        with open('sampleResultsP1.json') as f:
+            static = feed(json.loads(f.read()))
+        directory = tempfile.mkdtemp()
+        replay = ReplayTransport(directory)
+        engine = CSE('python docs', {}, api_key='testkey',
+                engine_id='TestEngine', transport=replay, **isolated())
+        self.assertRaises(CassetteError, engine.next)
+        engine = CSE('python docs', {}, api_key='testkey',
+                engine_id='TestEngine',
+                transport=RecordTransport(static, directory), **isolated())
+        engine.next()
+        self.assertEqual(len(os.listdir(directory)), 1)
+        #replayed with any API key
+        engine = CSE('python docs', {}, api_key='otherkey',
+                engine_id='TestEngine', transport=replay, **isolated())
+        page = engine.next()
+        self.assertEqual(len(page.items), 10)
+        self.assertEqual(len(static.requests), 1)
+
+
+class TestFederated(unittest.TestCase):
+    def setUp(self):
+        with open('sampleResultsP1.json') as f:
+            self.p1 = json.loads(f.read())
+        with open('sampleResultsP2.json') as f:
+            self.p2 = json.loads(f.read())
+
+    def engine(self, engine_id, transport):
+        return CSE('python docs', {'number': 10}, api_key='testkey',
+                engine_id=engine_id, transport=transport)
+
+    def testInterleave(self):
+        self.assertEqual(interleave([[1, 2, 3], [4], [5, 6]]),
+                [1, 4, 5, 2, 6, 3])
+        self.assertEqual(interleave([]), [])
+
+    def testMerge(self):
+        p2 = json.loads(json.dumps(self.p2))
+        p2['items'][0]['link'] = self.p1['items'][0]['link'] + '#top'
+        engine = Federated('python docs', [
+            self.engine('A', feed(self.p1)), self.engine('B', feed(p2))],
+            {'number': 4})
+        page = engine.next()
+        self.assertEqual(page.title, 'Merged results - python docs')
+        self.assertEqual((page.startIndex, page.count), (1, 4))
+        links = [page.nextItem().link for i in range(4)]
+        self.assertEqual(links, [self.p1['items'][0]['link'],
+            self.p1['items'][1]['link'], p2['items'][1]['link'],
+            self.p1['items'][2]['link']])
+        self.assertEqual(engine.maxPages, 5)
+        self.assertEqual(engine.next().startIndex, 5)
+        self.assertEqual((engine.errors, engine.late), ([], []))
+        # Only the merged pages are kept.
+        self.assertEqual(engine.engines, [])
+        self.assertEqual(engine.memoryUsage(),
+                CacheResults.memoryUsage(engine))
+
+    def testDeadline(self):
+        gate = threading.Event()
+        with open('sample400Error.json') as f:
+            error = json.loads(f.read())[1]
+        slow = self.engine('B', DTransport({None: self.p2}, gate))
+        engine = Federated('python docs', [self.engine('A', feed(self.p1)),
+            slow, self.engine('C', feed(error, 400))], {'number': 10},
+            timeout=0.2)
+        page = engine.next()
+        gate.set()
+        self.assertEqual(page.count, 10)
+        self.assertEqual(page.nextItem().link, self.p1['items'][0]['link'])
+        self.assertEqual(engine.late, [slow])
+        self.assertEqual(len(engine.errors), 1)
+        self.assertTrue(isinstance(engine.errors[0][1], GoogleAPIError))
+
+    def testNoAnswer(self):
+        gate = threading.Event()
+        engine = Federated('python docs',
+                [self.engine('A', DTransport({None: self.p1}, gate))],
+                timeout=0.05)
+        self.assertRaises(SearchTimeoutError, engine.next)
+        gate.set()
+        with open('sampleNoResults.json') as f:
+            engine = Federated('python docs',
+                    [self.engine('B', feed(json.loads(f.read())))])
+        self.assertEqual(engine.next().count, 0)
+
+
+class DAsyncTransport(DTransport):
+    """DTransport for async engines."""
+    def get(self, url, params):
+        future = asyncio.Future()
+        future.set_result(DTransport.get(self, url, params))
+        return future
+
+
+@unittest.skipIf(sys.version_info[0] < 3, 'asyncio engines require Python 3')
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        with open('sampleResultsP1.json') as f:
+            self.p1 = json.loads(f.read())
+        with open('sampleResultsP2.json') as f:
+            self.p2 = json.loads(f.read())
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def engine(self, transport, **kwargs):
+        return AsyncCSE('python docs', {'number': 10, 'maxPages': 2},
+                api_key='testkey', engine_id='TestEngine',
+                transport=transport, flight=AsyncSingleFlight(), **kwargs)
+
+    def testPages(self):
+        transport = DAsyncTransport({None: self.p1, 11: self.p2})
+        engine = self.engine(transport)
+        page = self.loop.run_until_complete(engine.next())
+        self.assertEqual(page.startIndex, 1)
+        self.assertRegexpMatches(page.nextItem().title,
+            recode('Overview.*Python.*documentation'))
+        page = self.loop.run_until_complete(engine.next())
+        self.assertEqual(page.startIndex, 11)
+        page = self.loop.run_until_complete(engine.previous())
+        self.assertEqual(page.startIndex, 1)
+        self.assertEqual(len(transport.requests), 2)
+
+    def testDeadline(self):
+        class Pending(Transport):
+            def get(self, url, params):
+                return asyncio.Future()
+
+        cache = ResultCache(':memory:', ttl=-1, stale=3600)
+        engine = self.engine(Pending(), cache=cache, deadline=Deadline(0.05))
+        cache.set(engine.requestKey(), self.p1)
+        page = self.loop.run_until_complete(engine.next())
+        self.assertEqual(page.startIndex, 1)
+        engine = self.engine(Pending(), deadline=Deadline(0.05))
+        self.assertRaises(SearchTimeoutError, self.loop.run_until_complete,
+                engine.next())
+        cache.close()
+
+    @unittest.skipIf(aiohttp is None, 'requires the aiohttp package')
+    def testRetry(self):
+        p1 = self.p1
+        class Flaky(Transport):
+            requests = 0
+            def get(self, url, params):
+                self.requests += 1
+                if self.requests == 1:
+                    raise aiohttp.ServerDisconnectedError()
+                future = asyncio.Future()
+                future.set_result(DResponse(p1))
+                future.result().status_code = 200
+                return future
+
+        transport = Flaky()
+        engine = self.engine(transport, breaker=CircuitBreaker(),
+                backoff=0.001)
+        page = self.loop.run_until_complete(engine.next())
+        self.assertEqual(page.startIndex, 1)
+        self.assertEqual(transport.requests, 2)
+
+    @unittest.skipIf(aiohttp is None, 'requires the aiohttp package')
+    def testRetryUndecodable(self):
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer
+        statuses = [502, 200, 503, 503, 503]
+        body = json.dumps(self.p1)
+
+        async def handler(request):
+            status = statuses.pop(0)
+            if status != 200:
+                return web.Response(status=status, content_type='text/html',
+                        text='<html><body>Bad Gateway</body></html>')
+            return web.Response(text=body, content_type='application/json')
+
+        app = web.Application()
+        app.router.add_get('/', handler)
+        server = TestServer(app)
+        self.loop.run_until_complete(server.start_server())
+        transport = AsyncHTTPTransport()
+        breaker = CircuitBreaker()
+        try:
+            engine = self.engine(transport, breaker=breaker, backoff=0.001,
+                    metrics=Metrics())
+            engine.url = str(server.make_url('/'))
+            page = self.loop.run_until_complete(engine.next())
+            self.assertEqual(page.startIndex, 1)
+            engine = self.engine(transport, breaker=breaker, backoff=0.001,
+                    metrics=Metrics())
+            engine.url = str(server.make_url('/'))
+            engine['q'] = 'other docs'
+            self.assertRaisesRegexp(GoogleAPIError, '503',
+                    self.loop.run_until_complete, engine.next())
+            self.assertEqual(statuses, [])
+            self.assertEqual(breaker.failures, 3)
+        finally:
+            self.loop.run_until_complete(transport.close())
+            self.loop.run_until_complete(server.close())
+
+    def testPrefetch(self):
+        transport = DAsyncTransport({None: self.p1, 11: self.p2})
+        engine = self.engine(transport, prefetch=True)
+        self.loop.run_until_complete(engine.next())
+        self.assertEqual(len(engine.pages), 2)
+        self.assertEqual(len(transport.requests), 2)
+
+    def testSingleFlight(self):
+        transport = DAsyncTransport({None: self.p1})
+        flight = AsyncSingleFlight()
+        engines = [AsyncCSE('python docs', {}, api_key='testkey',
+            engine_id='TestEngine', transport=transport, flight=flight)
+            for i in range(3)]
+        pages = self.loop.run_until_complete(asyncio.gather(
+            *[engine.next() for engine in engines]))
+        self.assertEqual(len(transport.requests), 1)
+        self.assertEqual([page.startIndex for page in pages], [1, 1, 1])
+
+    def testErrors(self):
+        with open('sampleLegacyError.json', 'r') as f:
+            j = json.loads(f.read())
+        engine = AsyncLegacy('python docs', {},
+                transport=DAsyncTransport({None: j}))
+        self.assertRaisesRegexp(GoogleAPIError, '\\(AsyncLegacy\\)\\s400',
+                self.loop.run_until_complete, engine.next())
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(workers=1, maxQueue=2)
+        self.results = []
+        self.done = threading.Event()
+        self.block = threading.Event()
+
+    def tearDown(self):
+        self.block.set()
+        self.pool.stop()
+
+    def testCallbacks(self):
+        def fail():
+            raise ValueError('failed')
+        self.pool.maxQueue = 3
+        self.pool.submit(lambda: 1, self.results.append)
+        self.pool.submit(fail, None, self.results.append)
+        self.pool.submit(self.done.set)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.results[0], 1)
+        self.assertTrue(isinstance(self.results[1], ValueError))
+
+    def testFailingCallback(self):
+        def fail(result):
+            raise ValueError('callback failed')
+        self.pool.maxQueue = 4
+        self.pool.submit(lambda: 1, fail)
+        self.pool.submit(lambda: 1 / 0, None, fail)
+        self.pool.submit(lambda: 2, self.results.append)
+        self.pool.submit(self.done.set)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.results, [2])
+        self.assertEqual(self.pool.queued, 0)
+
+    def testOverload(self):
+        self.pool.submit(self.block.wait)
+        time.sleep(0.1)
+        self.pool.submit(lambda: None)
+        self.pool.submit(lambda: None)
+        self.assertEqual(self.pool.queued, 2)
+        self.assertRaises(PoolFullError, self.pool.submit, lambda: None)
+
+    def testCancel(self):
+        self.pool.submit(self.block.wait)
+        time.sleep(0.1)
+        self.pool.submit(lambda: 'old', self.results.append, key='#chan')
+        self.pool.submit(lambda: 'new', self.results.append, key='#chan')
+        self.assertEqual(self.pool.queued, 1)
+        self.pool.submit(self.done.set)
+        self.block.set()
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.results, ['new'])
+
+
+class STransport(Transport):
+    """Transport answering requests with (data, status_code) responses in
+    turn."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, params):
+        self.requests.append((url, dict(params)))
+        data, status_code = self.responses.pop(0)
+        if isinstance(data, Exception):
+            raise data
+        if isinstance(data, bytes):
+            class Raw(object):
+                pass
+            raw = Raw()
+            raw.status_code, raw.content = status_code, data
+            return HTTPResponse(raw)
+        response = DResponse(data)
+        response.status_code = status_code
+        return response
+
+
+class TestRetries(unittest.TestCase):
+    def setUp(self):
+        with open('sample400Error.json') as f:
+            self.errors = json.loads(f.read())
+        with open('sampleResultsP1.json') as f:
+            self.data = json.loads(f.read())
+        self.breaker = CircuitBreaker(threshold=3, cooldown=60)
+
+    def engine(self, responses, **kwargs):
+        return CSE('retry docs', {'number': 10}, api_key='testkey',
+                engine_id='TestEngine', transport=STransport(responses),
+                breaker=self.breaker, backoff=0.001, metrics=Metrics(),
+                **kwargs)
+
+    def testBreaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=10)
+        breaker.failure(now=0)
+        breaker.allow(now=0)
+        breaker.failure(now=1)
+        self.assertRaises(CircuitOpenError, breaker.allow, 5)
+        breaker.allow(now=11)
+        self.assertRaises(CircuitOpenError, breaker.allow, 12)
+        breaker.failure(now=12)
+        self.assertRaises(CircuitOpenError, breaker.allow, 21)
+        breaker.allow(now=22)
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.allow(now=23)
+
+    def testRetry(self):
+        error = self.errors[2]
+        engine = self.engine([(error, 500), (IOError('reset'), None),
+            (self.data, 200)])
+        self.assertEqual(engine.next().count, 10)
+        self.assertEqual(len(engine.transport.requests), 3)
+        self.assertEqual(engine.metrics.counters['retries'], 2)
+        self.assertEqual(self.breaker.failures, 0)
+
+        engine = self.engine([(error, 500)] * 3, retries=1)
+        self.assertRaises(GoogleAPIError, engine.next)
+        self.assertEqual(len(engine.transport.requests), 2)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def testRetryUndecodable(self):
+        html = b'<html><body>503 Service Unavailable</body></html>'
+        engine = self.engine([(html, 503), (self.data, 200)])
+        self.assertEqual(engine.next().count, 10)
+        self.assertEqual(len(engine.transport.requests), 2)
+        engine = self.engine([(html, 502)] * 3)
+        self.assertRaisesRegexp(GoogleAPIError, '502: Undecodable',
+                engine.next)
+        self.assertEqual(len(engine.transport.requests), 3)
+        self.assertEqual(self.breaker.failures, 3)
+        self.breaker.success()
+        with open('sampleLegacyItems.json') as f:
+            legacy = json.loads(f.read())
+        engine = Legacy('retry docs', {}, breaker=self.breaker,
+                backoff=0.001, metrics=Metrics(),
+                transport=STransport([(html, 504), (legacy, 200)]))
+        self.assertEqual(engine.next().count, len(legacy['responseData']
+            ['results']))
+
+    def testNoRetry(self):
+        engine = self.engine([(self.errors[1], 400), (self.data, 200)])
+        self.assertRaises(GoogleAPIError, engine.next)
+        self.assertEqual(len(engine.transport.requests), 1)
+        engine = self.engine([(self.errors[2], 500), (self.data, 200)],
+                deadline=Deadline(0))
+        self.assertRaises(GoogleAPIError, engine.next)
+
+    def testCircuitOpen(self):
+        error = self.errors[2]
+        self.assertRaises(GoogleAPIError,
+                self.engine([(error, 500)] * 3).next)
+        self.assertEqual(self.breaker.state, 'open')
+        engine = self.engine([(self.data, 200)])
+        self.assertRaises(CircuitOpenError, engine.next)
+        self.assertEqual(engine.transport.requests, [])
+
+    def testRateLimit(self):
+        error = json.loads(json.dumps(self.errors[3]))
+        error['error']['errors'][0]['reason'] = 'rateLimitExceeded'
+        engine = self.engine([(error, 403), (self.data, 200)])
+        self.assertRaises(GoogleAPIError, engine.next)
+        self.assertEqual(len(engine.transport.requests), 1)
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(engine.metrics.counters['breaker.tripped'], 1)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def testTokenBucket(self):
+        bucket = TokenBucket(2, 1, updated=0)
+        self.assertEqual(bucket.delay(1, now=0), 0)
+        bucket.take()
+        bucket.take()
+        self.assertEqual(bucket.delay(1, now=0), 1)
+        self.assertEqual(bucket.delay(1, now=0.5), 0.5)
+        self.assertEqual(bucket.refill(now=10), 2)
+
+    def testDailyQuota(self):
+        limiter = RateLimiter(daily=2, perSecond=100)
+        limiter.reserve('testkey')
+        limiter.reserve('testkey', '#test', 5)
+        self.assertRaisesRegexp(QuotaExceededError, 'quota exhausted',
+                limiter.reserve, 'testkey')
+        self.assertEqual(limiter.reserve('otherkey'), 0)
+        self.assertEqual(limiter.status('testkey')[0][1:], (0, 2))
+
+    def testChannelQuota(self):
+        limiter = RateLimiter(daily=10, perSecond=100)
+        limiter.reserve('testkey', '#test', 1)
+        self.assertRaisesRegexp(QuotaExceededError, 'this channel',
+                limiter.reserve, 'testkey', '#TEST', 1)
+        limiter.reserve('testkey', '#other', 1)
+        self.assertEqual([s[1] for s in limiter.status('testkey', '#test', 1)],
+                [8, 0])
+
+    def testPerSecond(self):
+        limiter = RateLimiter(daily=100, perSecond=1, maxWait=0.5)
+        self.assertEqual(limiter.reserve('testkey'), 0)
+        self.assertRaisesRegexp(QuotaExceededError, 'Too many',
+                limiter.reserve, 'testkey')
+        limiter.maxWait = 2
+        self.assertTrue(0 < limiter.reserve('testkey') <= 1)
+
+    def testPersistence(self):
+        path = os.path.join(tempfile.mkdtemp(), 'quota.sqlite3')
+        limiter = RateLimiter(path, daily=5, perSecond=100)
+        limiter.reserve('testkey')
+        limiter.reserve('testkey')
+        row = limiter.db.execute('SELECT used, day FROM quota').fetchone()
+        self.assertEqual(tuple(row), (2, quotaDay()))
+        limiter.close()
+        limiter = RateLimiter(path, daily=5, perSecond=100)
+        self.assertEqual(limiter.status('testkey')[0][1], 3)
+        limiter.close()
+
+    def testDayBoundary(self):
+        limiter = RateLimiter(daily=2, perSecond=100)
+        now = time.time()
+        end = now
+        while quotaDay(end) == quotaDay(now):
+            end += 600
+        # Nothing comes back during the day, however long the wait.
+        limiter.reserve('testkey', now=now)
+        limiter.reserve('testkey', now=now)
+        self.assertRaises(QuotaExceededError, limiter.reserve, 'testkey',
+                now=end - 600)
+        self.assertEqual(limiter.status('testkey', now=end - 600)[0][1], 0)
+        # The whole budget is back once the next quota day starts.
+        self.assertEqual(limiter.status('testkey', now=end)[0][1], 2)
+        limiter.reserve('testkey', now=end)
+        limiter.reserve('testkey', now=end + 1)
+        self.assertRaises(QuotaExceededError, limiter.reserve, 'testkey',
+                now=end + 2)
+
+    def testEngineQuota(self):
+        with open('sampleResultsP1.json') as f:
+            transport = DTransport({None: json.loads(f.read())})
+        limiter = RateLimiter(daily=1, perSecond=100)
+        engine = CSE('python docs', {}, api_key='testkey',
+                engine_id='TestEngine', transport=transport, limiter=limiter)
+        engine.next()
+        engine = CSE('python', {}, api_key='testkey',
+                engine_id='TestEngine', transport=transport, limiter=limiter)
+        self.assertRaises(QuotaExceededError, engine.next)
+        self.assertEqual(len(transport.requests), 1)
+
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.evicted = []
+        self.store = SessionStore(maxSessions=2, timeout=60, sizeof=len,
+                onEvict=lambda *args: self.evicted.append(args))
+
+    def testCount(self):
+        self.store['#a'] = 'a'
+        self.store['#b'] = 'b'
+        self.store['#a']
+        self.store['#c'] = 'c'
+        self.assertEqual(sorted(self.store), ['#a', '#c'])
+        self.assertEqual(self.evicted, [('#b', 'b', 'count')])
+        self.assertEqual(self.store.evictions['count'], 1)
+
+    def testIdle(self):
+        self.store['#a'] = 'a'
+        self.store.timeout = -1
+        self.store.expire()
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.evicted, [('#a', 'a', 'idle')])
+        self.assertEqual(self.store.get('#a'), None)
+
+    def testMemory(self):
+        self.store.maxMemory = 5
+        self.store['#a'] = 'aaa'
+        self.store['#b'] = 'bb'
+        self.assertEqual(self.store.memory, 5)
+        self.store['#b'] = 'bbb'
+        self.assertEqual(list(self.store), ['#b'])
+        self.assertEqual(self.store.memory, 3)
+        self.assertEqual(self.evicted, [('#a', 'aaa', 'memory')])
+        self.store['#c'] = 'cccccc'
+        self.assertEqual(list(self.store), ['#c'])
+        self.assertEqual(self.store.pop('#c'), 'cccccc')
+        self.assertEqual(self.store.memory, 0)
+
+    def testEngineMemory(self):
+        with open('sampleResultsP1.json') as f:
+            transport = DTransport({None: json.loads(f.read())})
+        engine = CSE('python docs', {}, api_key='testkey',
+                engine_id='TestEngine', transport=transport)
+        self.assertEqual(engine.memoryUsage(), 0)
+        engine.next()
+        size = engine.memoryUsage()
+        self.assertTrue(size > 0)
+        engine.currentPage.nextItem().title
+        self.assertTrue(engine.memoryUsage() > size)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def testCases(self):
+        for name, fn in bench.cases().items():
+            fn()
+        self.assertEqual(len(bench.CSEPages(json.loads(
+            bench.synthetic(100))).items), 100)
+
+    def testCompare(self):
+        baseline = {'a': {'ops': 100, 'blocks': 10, 'peak': 1000}}
+        report = {'a': {'ops': 80, 'blocks': 10, 'peak': 1000}}
+        self.assertEqual(bench.compare(report, baseline, 0.25), [])
+        report = {'a': {'ops': 70, 'blocks': 20, 'peak': 1000}}
+        self.assertEqual(len(bench.compare(report, baseline, 0.25)), 2)
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResultCache(':memory:', ttl=60, maxEntries=2)
+        with open('sampleResultsP1.json') as f:
+            self.data = json.loads(f.read())
+
+    def tearDown(self):
+        self.cache.close()
+
+    def engine(self, q='python docs'):
+        return CSE(q, {'number': 10}, api_key='testkey',
+                engine_id='TestEngine', cache=self.cache)
+
+    def testGetSet(self):
+        key = self.engine().requestKey()
+        self.assertEqual(self.cache.get(key), None)
+        self.cache.set(key, self.data)
+        self.assertEqual(self.cache.get(key), self.data)
+        self.assertEqual(self.cache.list()[0]['hits'], 1)
+        self.assertEqual(self.engine('  Python   DOCS ').requestKey(), key)
+
+    def testExpiry(self):
+        key = self.engine().requestKey()
+        self.cache.set(key, self.data)
+        self.cache.ttl = -1
+        self.assertEqual(self.cache.get(key), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def testStale(self):
+        key = self.engine().requestKey()
+        self.cache.set(key, self.data)
+        self.cache.ttl = -1
+        self.cache.stale = 3600
+        self.assertEqual(self.cache.get(key), None)
+        self.assertEqual(self.cache.getStale(key), self.data)
+        self.cache.stale = 0
+        self.assertEqual(self.cache.getStale(key), None)
+        self.assertEqual(self.cache.get(key), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def testDeadline(self):
+        with open('sampleResultsP2.json') as f:
+            p2 = json.loads(f.read())
+        engine = self.engine('deadline docs')
+        key = engine.requestKey()
+        self.cache.set(key, self.data)
+        self.cache.ttl = -1
+        self.cache.stale = 3600
+        gate = threading.Event()
+        engine.transport = DTransport({None: p2}, gate)
+        engine.metrics = Metrics()
+        engine.deadline = Deadline(0.05)
+        page = engine.next()
+        self.assertEqual(page.nextItem().link, self.data['items'][0]['link'])
+        self.assertEqual(engine.metrics.counters['cache.stale'], 1)
+        # The request completes in the background and replaces the copy.
+        gate.set()
+        for i in range(100):
+            if self.cache.getStale(key) != self.data:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.cache.getStale(key), p2)
+
+        # Requests slower than the time left are not waited for.
+        engine = self.engine('deadline docs')
+        gate = threading.Event()
+        engine.transport = DTransport({None: self.data}, gate)
+        engine.metrics = Metrics()
+        engine.metrics.observe('http', 5.0)
+        engine.deadline = Deadline(2.0)
+        engine.next()
+        self.assertTrue(engine.deadline.remaining() > 1.0)
+        gate.set()
+
+        engine = self.engine('deadline missing')
+        gate = threading.Event()
+        engine.transport = DTransport({None: self.data}, gate)
+        engine.deadline = Deadline(0.05)
+        self.assertRaises(SearchTimeoutError, engine.next)
+        gate.set()
+
+    def testNegative(self):
+        key = self.engine().requestKey()
+        self.cache.setNegative(key, {'items': []})
+        self.assertEqual(self.cache.getNegative(key), (200, {'items': []}))
+        self.assertEqual(self.cache.get(key), None)
+        self.cache.errorTtl = 0
+        self.cache.setNegative(key, {'error': {}}, 400)
+        self.assertEqual(self.cache.getNegative(key), (200, {'items': []}))
+        self.cache.emptyTtl = -1
+        self.assertEqual(self.cache.getNegative(key), None)
+        self.cache.emptyTtl = 60
+        self.cache.set(key, self.data)
+        self.assertEqual(self.cache.getNegative(key), None)
+
+    def testEngineNegative(self):
+        with open('sampleNoResults.json') as f:
+            empty = json.loads(f.read())
+        with open('sample400Error.json') as f:
+            errors = json.loads(f.read())
+        engine = self.engine('negative docs')
+        engine.transport = feed(empty)
+        self.assertEqual(engine.next().count, 0)
+        self.assertEqual(len(self.cache), 0)
+        engine = self.engine('negative docs')
+        engine.transport = feed(self.data)
+        self.assertEqual(engine.next().count, 0)
+        self.assertEqual(engine.transport.requests, [])
+
+        for error, cached in ((errors[1], True), (errors[0], False)):
+            self.cache.db.execute('DELETE FROM negative')
+            engine = self.engine('invalid docs')
+            engine.transport = feed(error, 400)
+            self.assertRaises(GoogleAPIError, engine.next)
+            engine = self.engine('invalid docs')
+            engine.transport = feed(self.data)
+            if cached:
+                self.assertRaisesRegexp(GoogleAPIError, 'invalid',
+                        engine.next)
+                self.assertEqual(engine.transport.requests, [])
+            else:
+                self.assertEqual(engine.next().count, 10)
+
+    def testEviction(self):
+        keys = [self.engine(q).requestKey() for q in ('a', 'b', 'c')]
+        self.cache.set(keys[0], self.data)
+        self.cache.set(keys[1], self.data)
+        time.sleep(0.01)
+        self.cache.get(keys[0])
+        self.cache.set(keys[2], self.data)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get(keys[1]), None)
+        self.assertNotEqual(self.cache.get(keys[0]), None)
+
+    def testEngineCache(self):
+        engine = self.engine()
+        engine.transport = feed(self.data)
+        engine.next()
+        #served from the cache, no request made
+        page = self.engine().next()
+        self.assertEqual(page.title,
+                recode('Google Custom Search - python docs'))
+        self.assertEqual(len(page.items), 10)
+
+    def testNoCache(self):
+        engine = CSE('python docs', {'number': 10}, api_key='testkey',
+                engine_id='TestEngine', cache=self.cache, useCache=False)
+        engine.transport = feed(self.data)
+        engine.next()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(engine.saveCache(), 1)
+        self.assertEqual(engine.saveCache(), 0)
+        self.assertEqual(len(self.cache), 1)
+
+    def testCanonicalQuery(self):
+        self.assertEqual(normalizeQuery(u' Python\u3000 DOCS\t'),
+                'python docs')
+        self.assertEqual(normalizeQuery(u'\uff30ython Stra\u00dfe'),
+                'python strasse')
+        self.assertEqual(normalizeQuery('docs python docs', True),
+                'docs python')
+        engine = self.engine('Python  Docs')
+        engine.transport = feed(self.data)
+        engine.next()
+        self.assertEqual(engine.transport.requests[0][1]['q'], 'Python  Docs')
+        self.assertEqual(self.engine(u'python \uff44ocs').next().count, 10)
+        self.assertFalse(self.cache.contains(self.engine('docs python'
+            ).requestKey()))
+        engine = CSE('docs python', {'number': 10}, api_key='testkey',
+                engine_id='TestEngine', cache=self.cache, unordered=True)
+        engine.transport = feed(self.data)
+        engine.next()
+        engine = CSE('python docs', {'number': 10}, api_key='testkey',
+                engine_id='TestEngine', cache=self.cache, unordered=True)
+        engine.transport = feed(self.data)
+        engine.next()
+        self.assertEqual(engine.transport.requests, [])
+
+    def testRefresh(self):
+        engine = self.engine()
+        engine.transport = feed(self.data)
+        engine.next()
+        self.engine().next()
+        self.assertEqual(self.cache.list()[0]['hits'], 1)
+        created, accessed = self.cache.db.execute('SELECT created, accessed'
+                ' FROM results').fetchone()
+        time.sleep(0.01)
+        engine.refresh()
+        self.assertEqual(len(engine.transport.requests), 2)
+        row = self.cache.db.execute('SELECT created, accessed, hits FROM'
+                ' results').fetchone()
+        self.assertTrue(row['created'] > created)
+        # A refresh is not a use of the entry.
+        self.assertEqual(row['accessed'], accessed)
+        self.assertEqual(row['hits'], 0)
+
+    def testSearch(self):
+        engine = self.engine()
+        engine.transport = feed(self.data)
+        engine.next()
+        items = self.cache.search('python documentation')
+        self.assertTrue(len(items) > 0)
+        self.assertRegexpMatches(items[0][0], 'Python.*[Dd]ocumentation')
+        self.assertEqual(len(self.cache.search('python', limit=3)), 3)
+        self.assertEqual(self.cache.search('"zzzz'), [])
+        self.assertEqual(len(set(link for title, link, snippet in
+            self.cache.search('python'))), 10)
+        #replaced and removed entries leave the index
+        engine.refresh()
+        self.assertEqual(len(self.cache.search('python')), 10)
+        self.cache.remove(self.cache.list()[0]['id'])
+        self.assertEqual(self.cache.search('python'), [])
+        count = self.cache.db.execute('SELECT COUNT(*) FROM result_index'
+                ).fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def testCacheResults(self):
+        engine = self.engine()
+        engine.transport = feed(self.data)
+        engine.next()
+        items = self.cache.search('python')
+        engine = CacheResults('python', items, {'number': 4})
+        self.assertEqual(engine.maxPages, 3)
+        page = engine.next()
+        self.assertEqual((page.startIndex, page.count), (1, 4))
+        self.assertEqual(page.nextItem().link, items[0][1])
+        self.assertEqual(engine.next().startIndex, 5)
+        self.assertEqual(engine.next().count, 2)
+        self.assertRaises(IndexError, engine.next)
+        self.assertEqual(engine.previous().startIndex, 5)
+
+    def testAddColumns(self):
+        path = os.path.join(tempfile.mkdtemp(), 'old.sqlite3')
+        db = sqlite3.connect(path)
+        db.execute(sql.SCHEMA[0].replace('fields TEXT,', '').replace(
+            'original TEXT,', ''))
+        db.close()
+        db = sql.connect(path)
+        columns = [row['name'] for row in
+                db.execute('PRAGMA table_info(results)')]
+        self.assertTrue('fields' in columns)
+        self.assertTrue('original' in columns)
+        db.close()
+
+    def testExpiring(self):
+        for q in ('hot', 'cold'):
+            self.cache.set(self.engine(q).requestKey(), self.data)
+        self.cache.get(self.engine('hot').requestKey())
+        self.assertEqual(self.cache.expiring(30), [])
+        rows = self.cache.expiring(60)
+        self.assertEqual([row['q'] for row in rows], ['hot'])
+        self.assertEqual(len(self.cache.expiring(60, minHits=0)), 2)
+
+    def testOriginalQuery(self):
+        engine = self.engine('Python  DOCS')
+        engine.transport = feed(self.data)
+        engine.next()
+        self.cache.set(self.engine('hot').requestKey(), self.data)
+        rows = self.cache.expiring(60, minHits=0)
+        self.assertEqual(sorted((row['q'], row['original']) for row in rows),
+                [('hot', 'hot'), ('python docs', 'Python  DOCS')])
+        self.assertEqual(self.cache.list()[1]['original'], 'Python  DOCS')
+
+
+class TestCacheRefresher(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResultCache(':memory:', ttl=60, maxEntries=10)
+        with open('sampleResultsP1.json') as f:
+            data = json.loads(f.read())
+        for i in range(5):
+            key = ('cse', 'TestEngine', 'q{0}'.format(i), None, 10, None,
+                    None)
+            self.cache.set(key, data)
+            for hit in range(i):
+                self.cache.get(key)
+        self.refresher = CacheRefresher(self.cache, interval=10, margin=60,
+                minHits=2, share=0.5)
+        self.fetched = []
+
+    def tearDown(self):
+        self.cache.close()
+
+    def testDue(self):
+        now = self.refresher.last
+        self.assertFalse(self.refresher.due(now + 5))
+        self.assertTrue(self.refresher.due(now + 10))
+        self.assertFalse(self.refresher.due(now + 30))
+        self.refresher.done()
+        self.assertTrue(self.refresher.due(now + 40))
+        self.refresher.interval = 0
+        self.refresher.done()
+        self.assertFalse(self.refresher.due(now + 100))
+
+    def testBudget(self):
+        count = self.refresher.refresh(self.fetched.append, 4)
+        self.assertEqual(count, 2)
+        self.assertEqual([row['q'] for row in self.fetched], ['q4', 'q3'])
+        self.assertEqual(self.refresher.refresh(self.fetched.append, 1), 0)
+
+    def testErrors(self):
+        errors = []
+        def fetch(row):
+            if row['q'] == 'q4':
+                raise APIError('failed')
+            if row['q'] == 'q2':
+                raise QuotaExceededError('exhausted')
+            self.fetched.append(row['q'])
+        count = self.refresher.refresh(fetch, 100,
+                lambda row, e: errors.append(row['q']))
+        self.assertEqual(count, 1)
+        self.assertEqual(self.fetched, ['q3'])
+        self.assertEqual(errors, ['q4', 'q2'])
+        self.assertFalse(self.refresher.running)
+
+    def testRefreshOnce(self):
+        with open('sampleResultsP1.json') as f:
+            transport = feed(json.loads(f.read()))
+        def fetch(row):
+            self.fetched.append(row['q'])
+            CSE(row['original'], {'number': row['num'], 'fields': ''},
+                    api_key='testkey', engine_id=row['cx'],
+                    cache=self.cache, transport=transport,
+                    **isolated()).refresh()
+        self.assertEqual(self.refresher.refresh(fetch, 100), 3)
+        self.assertEqual(len(transport.requests), 3)
+        # Without new hits the entries are not refreshed again.
+        self.assertEqual(self.refresher.refresh(fetch, 100), 0)
+        key = ('cse', 'TestEngine', 'q2', None, 10, None, None)
+        self.cache.get(key)
+        self.cache.get(key)
+        self.assertEqual(self.refresher.refresh(fetch, 100), 1)
+        self.assertEqual(self.fetched, ['q4', 'q3', 'q2', 'q2'])
+
+
+class TestMetrics(unittest.TestCase):
+    def testHistogram(self):
+        histogram = Histogram()
+        for seconds in (0.0002, 0.0002, 0.003, 0.04, 20.0):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.percentile(40), 0.00025)
+        self.assertEqual(histogram.percentile(50), 0.005)
+        self.assertEqual(histogram.percentile(80), 0.05)
+        self.assertEqual(histogram.percentile(100), 20.0)
+        self.assertEqual(Histogram().percentile(50), 0.0)
+
+    def testEngine(self):
+        with open('sampleResultsP1.json') as f:
+            data = json.loads(f.read())
+        metrics = Metrics()
+        cache = ResultCache(':memory:')
+        for i in range(2):
+            engine = CSE('python docs', {}, api_key='testkey',
+                    engine_id='TestEngine', cache=cache, metrics=metrics,
+                    transport=feed(data))
+            engine.next()
+        limiter = RateLimiter(daily=1)
+        limiter.reserve('testkey')
+        engine = CSE('python', {}, api_key='testkey', engine_id='TestEngine',
+                limiter=limiter, metrics=metrics, transport=feed(data))
+        self.assertRaises(QuotaExceededError, engine.next)
+        cache.close()
+        self.assertEqual(metrics.counters, {'cache.miss': 1, 'cache.hit': 1,
+            'requests': 1, 'quota.refused': 1})
+        self.assertEqual(sorted(metrics.histograms),
+                ['decode', 'http', 'parse'])
+        self.assertEqual(metrics.histograms['parse'].count, 2)
+        self.assertEqual(len(metrics.summary()), 4)
+        text = metrics.text()
+        self.assertTrue('googlecse_phase_seconds_count{phase="http"} 1'
+                in text)
+        self.assertTrue('googlecse_cache_hit_total 1' in text)
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.prom')
+        metrics.write(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), text)
+        metrics.reset()
+        self.assertEqual(metrics.summary(), [])
+
 # vim:set ts=4 sw=4 et tw=79:
@@ -0,0 +1,183 @@
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Transports carry engine requests.
+
+A transport has a get(url, params) method returning a response with a
+status_code attribute and a json() method. HTTPTransport sends requests to
+Google, ReplayTransport serves responses recorded in a cassette directory by
+RecordTransport and StaticTransport always returns the same response.
+"""
+import os
+import json
+import hashlib
+import threading
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except:
+    raise ImportError('Please install the requests package')
+
+from .exceptions import CassetteError
+from .utils import loads
+
+# Parameters left out of cassette names, so recordings can be replayed with
+# any API key.
+IGNORED_PARAMS = ('key',)
+
+
+class Response(object):
+    """Response with already decoded JSON data."""
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self._json = data
+
+    def json(self):
+        return self._json
+
+
+class HTTPResponse(object):
+    """Response of HTTPTransport. The body is decoded once, with the fastest
+    JSON decoder available."""
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.content = response.content
+        self._json = None
+
+    def json(self):
+        if self._json is None:
+            self._json = loads(self.content)
+        return self._json
+
+
+class Transport(object):
+    """Transport interface."""
+    def get(self, url, params):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HTTPTransport(Transport):
+    """Keep-alive HTTP session shared by all engines.
+
+    Connections to each host are pooled (up to poolSize) and reused between
+    requests. Every request is bounded by connectTimeout and readTimeout
+    seconds.
+    """
+    def __init__(self, poolSize=10, connectTimeout=5.0, readTimeout=10.0):
+        self._lock = threading.Lock()
+        self._session = None
+        self.poolSize = poolSize
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+
+    def configure(self, poolSize=None, connectTimeout=None, readTimeout=None):
+        if connectTimeout is not None:
+            self.connectTimeout = connectTimeout
+        if readTimeout is not None:
+            self.readTimeout = readTimeout
+        if poolSize is not None and poolSize != self.poolSize:
+            self.poolSize = poolSize
+            self.close()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.poolSize,
+                        pool_maxsize=self.poolSize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    @property
+    def timeout(self):
+        return (self.connectTimeout, self.readTimeout)
+
+    def get(self, url, params):
+        return HTTPResponse(self.session.get(url, params=params,
+            timeout=self.timeout))
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class StaticTransport(Transport):
+    """Returns response to every request and records the requests made."""
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def get(self, url, params):
+        self.requests.append((url, dict(params)))
+        return self.response
+
+
+def cassetteName(url, params):
+    """Return the cassette file name of a request."""
+    items = sorted((str(k), str(v)) for k, v in params.items()
+            if k not in IGNORED_PARAMS)
+    digest = hashlib.sha1(json.dumps([url, items]).encode('utf-8'))
+    return digest.hexdigest() + '.json'
+
+
+class ReplayTransport(Transport):
+    """Serves responses recorded in directory. Requests without a recording
+    raise CassetteError."""
+    def __init__(self, directory):
+        self.directory = directory
+        self._cassettes = {}
+
+    def get(self, url, params):
+        name = cassetteName(url, params)
+        cassette = self._cassettes.get(name)
+        if cassette is None:
+            path = os.path.join(self.directory, name)
+            if not os.path.exists(path):
+                raise CassetteError('No recording for {0} {1}'.format(url,
+                    sorted(params.items())))
+            with open(path, 'r') as f:
+                cassette = self._cassettes[name] = json.loads(f.read())
+        return Response(cassette['status_code'], cassette['body'])
+
+
+class RecordTransport(Transport):
+    """Sends requests through transport and records the responses in
+    directory for ReplayTransport."""
+    def __init__(self, transport, directory):
+        self.transport = transport
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, url, params):
+        response = self.transport.get(url, params)
+        cassette = {'url': url, 'status_code': response.status_code,
+            'params': dict((k, v) for k, v in params.items()
+                if k not in IGNORED_PARAMS),
+            'body': response.json()}
+        path = os.path.join(self.directory, cassetteName(url, params))
+        with open(path, 'w') as f:
+            f.write(json.dumps(cassette, indent=2, sort_keys=True))
+        return response
+
+    def close(self):
+        self.transport.close()
@@ -11,9 +11,349 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import sys
+import json
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from .metrics import clock
+from .exceptions import CircuitOpenError
+
+if sys.version_info[0] < 3:
+    from urlparse import urlsplit, urlunsplit
+else:
+    from urllib.parse import urlsplit, urlunsplit
+
+# Fastest available JSON decoder: orjson, ujson or the standard library.
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from ujson import loads
+    except ImportError:
+        loads = json.loads
+
+def normalizeQuery(query, unordered=False):
+    """Return the canonical form of query: NFKC normalized, case folded and
+    with whitespace collapsed. With unordered=True the words are sorted and
+    duplicates dropped, so word order does not matter."""
+    if sys.version_info[0] < 3:
+        if isinstance(query, str):
+            query = query.decode('utf-8')
+        query = unicodedata.normalize('NFKC', query).lower()
+    else:
+        query = unicodedata.normalize('NFKC', query).casefold()
+    words = query.split()
+    if unordered:
+        words = sorted(set(words))
+    return ' '.join(words)
+
+
+# Query parameters (or their prefixes) dropped by normalizeURL().
+TRACKING_PARAMS = ('utm_', 'gclid', 'fbclid', 'msclkid', 'mc_cid', 'mc_eid',
+    '_ga', 'yclid')
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+def normalizeURL(url):
+    """Return url in a form shared by links to the same page: scheme and
+    host lower cased, without default port, fragment, trailing slash and
+    tracking parameters."""
+    scheme, host, path, query, fragment = urlsplit(url.strip())
+    scheme = scheme.lower()
+    host = host.lower()
+    port = DEFAULT_PORTS.get(scheme)
+    if port and host.endswith(port):
+        host = host[:-len(port)]
+    if query:
+        query = '&'.join(param for param in query.split('&') if param and
+            not param.split('=', 1)[0].lower().startswith(TRACKING_PARAMS))
+    return urlunsplit((scheme, host, path.rstrip('/'), query, ''))
+
+
+def interleave(lists):
+    """Return the elements of lists in turn: the first of each list, then
+    the second of each and so on. Shorter lists drop out when exhausted."""
+    result = []
+    for index in range(max([len(l) for l in lists] or [0])):
+        for l in lists:
+            if index < len(l):
+                result.append(l[index])
+    return result
+
+
+class TokenBucket(object):
+    """Token bucket holding up to capacity tokens, refilled at rate tokens
+    per second."""
+    def __init__(self, capacity, rate, tokens=None, updated=None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now=None):
+        now = time.time() if now is None else now
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def delay(self, n=1, now=None):
+        """Return seconds until n tokens are available."""
+        tokens = self.refill(now)
+        if tokens >= n:
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        return (n - tokens) / float(self.rate)
+
+    def take(self, n=1):
+        self.tokens -= n
+
+
+class CircuitBreaker(object):
+    """Fail fast while requests keep failing.
+
+    After threshold consecutive failures, or a trip(), the breaker opens and
+    allow() raises CircuitOpenError for cooldown seconds. Then one trial
+    request is allowed per cooldown; a success closes the breaker, a failure
+    opens it again.
+    """
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        if time.time() - self.opened < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def allow(self, now=None):
+        """Raise CircuitOpenError unless a request may be sent."""
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.opened is None:
+                return
+            wait = self.opened + self.cooldown - now
+            if wait > 0:
+                raise CircuitOpenError('Google API unavailable, retry in {0}'
+                        ' seconds.'.format(int(wait) + 1))
+            # Let this request through as the trial, refuse the others.
+            self.opened = now
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self, now=None):
+        with self._lock:
+            self.failures += 1
+            if self.opened is not None or self.failures >= self.threshold:
+                self.opened = time.time() if now is None else now
+
+    def trip(self, now=None):
+        with self._lock:
+            self.failures = max(self.failures, self.threshold)
+            self.opened = time.time() if now is None else now
+
+
+class SessionStore(object):
+    """Mapping of sessions evicted by count, memory and idle time.
+
+    At most maxSessions entries are kept, least recently used first out. If
+    maxMemory is non-zero, entries are also evicted until the sum of
+    sizeof(value) is at most maxMemory bytes. Entries not accessed for
+    timeout seconds are dropped. onEvict(key, value, reason) is called for
+    every evicted entry and evictions counts them by reason ('count',
+    'memory' or 'idle').
+    """
+    def __init__(self, maxSessions=100, timeout=3600, maxMemory=0,
+            sizeof=None, onEvict=None):
+        self.maxSessions = maxSessions
+        self.timeout = timeout
+        self.maxMemory = maxMemory
+        self.sizeof = sizeof or (lambda value: 0)
+        self.onEvict = onEvict
+        self.evictions = {'count': 0, 'memory': 0, 'idle': 0}
+        self.memory = 0
+        self._lock = threading.RLock()
+        self._data = OrderedDict() # key: [value, accessed, size]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._data.pop(key)
+            entry[1] = time.time()
+            self._data[key] = entry
+            self._resize(entry)
+            value = entry[0]
+            self._evict()
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self.memory -= self._data.pop(key)[2]
+            entry = [value, time.time(), 0]
+            self._data[key] = entry
+            self._resize(entry)
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.memory -= self._data.pop(key)[2]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            entry = self._data.pop(key)
+            self.memory -= entry[2]
+            return entry[0]
+
+    def _resize(self, entry):
+        size = self.sizeof(entry[0])
+        self.memory += size - entry[2]
+        entry[2] = size
+
+    def expire(self):
+        """Drop idle and excess entries."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        evicted = []
+        while self._data:
+            key = next(iter(self._data))
+            value, accessed, size = self._data[key]
+            if accessed + self.timeout < now:
+                reason = 'idle'
+            elif len(self._data) > self.maxSessions:
+                reason = 'count'
+            elif self.maxMemory and self.memory > self.maxMemory and \
+                    len(self._data) > 1:
+                reason = 'memory'
+            else:
+                break
+            del self._data[key]
+            self.memory -= size
+            self.evictions[reason] += 1
+            evicted.append((key, value, reason))
+        if self.onEvict is not None:
+            for key, value, reason in evicted:
+                self.onEvict(key, value, reason)
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def within(fn, timeout):
+    """Call fn() on a daemon thread and wait at most timeout seconds for it
+    to return. Returns a call whose event is set once fn() returned, with its
+    result or error; after a timeout fn() keeps running in the background."""
+    call = _Call()
+
+    def run():
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+        finally:
+            call.event.set()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    call.event.wait(max(timeout, 0))
+    return call
+
+
+class Deadline(object):
+    """Time budget of a command: seconds from its creation."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = clock() + seconds
+
+    def remaining(self):
+        """Return the seconds left, 0 once expired."""
+        return max(self.expires - clock(), 0)
+
+    @property
+    def expired(self):
+        return clock() >= self.expires
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls sharing a key into one call."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, fn):
+        """Call fn() unless a call for key is already in progress, in which
+        case wait for it. Returns (result, shared) where shared is True if
+        the result came from another caller's call. Exceptions raised by fn()
+        are raised to every caller."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
 
 class ItemIndexTree(list):
-    "Tree based list type."""
+    """List with a cursor.
+
+    The cursor starts before the first item; next() and previous() move it
+    one item and window() several at once, all in constant time apart from
+    the items returned. next() and previous() raise IndexError at the ends,
+    window() returns fewer (or no) items instead.
+    """
     def __init__(self, items=None):
         if items and not isinstance(items, list):
             raise ValueError('Index Items must be a list()')
@@ -46,11 +386,7 @@ class ItemIndexTree(list):
         list.append(self, item)
 
     def __getitem__(self, item):
-        v = list.__getitem__(self, item)
-        try:
-            return ItemIndexTree(v)
-        except TypeError:
-            return v
+        return list.__getitem__(self, item)
 
     @property
     def current(self):
@@ -61,19 +397,45 @@ class ItemIndexTree(list):
             raise IndexError('item contains no values.')
         return list.__getitem__(self, self._current_index)
 
+    def hasNext(self):
+        if self._current_index is None:
+            return list.__len__(self) > 0
+        return self._current_index + 1 < list.__len__(self)
+
+    def hasPrevious(self):
+        return bool(self._current_index)
+
     def next(self):
+        if not self.hasNext():
+            raise IndexError('Out of range - No more next values')
         if self._current_index is None:
             self._current_index = 0
-        elif self._current_index + 2 > list.__len__(self):
-            raise IndexError('Out of range - No more next values')
         else:
             self._current_index += 1
         return self._current_index
 
     def previous(self):
-        if self._current_index == 0:
+        if not self.hasPrevious():
             raise IndexError('Out of range - No more previous values.')
+        self._current_index -= 1
+
+    def window(self, n, direction='next'):
+        """Move the cursor over up to n items and return them in list order:
+        the items after the cursor, ending on the last of them, or with
+        direction 'previous' the items before it, starting on the first."""
+        index = self._current_index
+        if direction == 'next':
+            start = 0 if index is None else index + 1
+            end = min(start + n, list.__len__(self))
+            if start >= end:
+                return []
+            self._current_index = end - 1
         else:
-            self._current_index -= 1
+            if not index:
+                return []
+            start = max(index - n, 0)
+            end = index
+            self._current_index = start
+        return list.__getitem__(self, slice(start, end))
 
 
@@ -0,0 +1,134 @@
+# Copyright (c) 2014 Julian Paul Glass. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import logging
+import threading
+
+if sys.version_info[0] < 3:
+    from Queue import Queue
+else:
+    from queue import Queue
+
+from .exceptions import PoolFullError
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    """Work item queued on a WorkerPool."""
+    def __init__(self, fn, callback=None, errback=None, key=None):
+        self.fn = fn
+        self.callback = callback
+        self.errback = errback
+        self.key = key
+        self.started = False
+        self.cancelled = False
+
+
+class WorkerPool(object):
+    """Bounded pool of worker threads.
+
+    At most maxQueue jobs may be waiting at a time, submit() raises
+    PoolFullError beyond that. Submitting a job with the key of an earlier
+    job cancels the earlier one: it is skipped if it has not started yet and
+    its callback is suppressed if it has.
+    """
+    def __init__(self, workers=4, maxQueue=16):
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._jobs = {}
+        self._queued = 0
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def submit(self, fn, callback=None, errback=None, key=None):
+        """Queue fn() to run on a worker. callback(result) is called with its
+        return value or errback(exception) if it raised."""
+        with self._lock:
+            if key is not None and key in self._jobs:
+                self._cancel(self._jobs.pop(key))
+            if self._queued >= self.maxQueue:
+                raise PoolFullError('Too many pending requests.')
+            job = Job(fn, callback, errback, key)
+            if key is not None:
+                self._jobs[key] = job
+            self._queued += 1
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                        name='GoogleCSE worker')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(job)
+        return job
+
+    def cancel(self, key):
+        """Cancel the job submitted with key, if any."""
+        with self._lock:
+            if key in self._jobs:
+                self._cancel(self._jobs.pop(key))
+
+    def _cancel(self, job):
+        job.cancelled = True
+        if not job.started:
+            self._queued -= 1
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            with self._lock:
+                if job.cancelled:
+                    continue
+                job.started = True
+                self._queued -= 1
+            try:
+                result = job.fn()
+            except Exception as e:
+                if self._finish(job) and job.errback:
+                    self._call(job.errback, e)
+            else:
+                if self._finish(job) and job.callback:
+                    self._call(job.callback, result)
+
+    @staticmethod
+    def _call(fn, arg):
+        """Call a callback or errback; its errors are logged so they do not
+        end the worker thread."""
+        try:
+            fn(arg)
+        except Exception:
+            log.exception('GoogleCSE worker callback failed:')
+
+    def _finish(self, job):
+        """Release job, returns False if it was cancelled."""
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+            return not job.cancelled
+
+    def stop(self):
+        with self._lock:
+            for job in self._jobs.values():
+                self._cancel(job)
+            self._jobs.clear()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
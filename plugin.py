@@ -28,6 +28,9 @@
 
 ###
 import re
+import collections
+import supybot.conf as conf
+import supybot.schedule as schedule
 import supybot.utils as utils
 from supybot.commands import *
 import supybot.plugins as plugins
@@ -41,7 +44,16 @@ except ImportError:
     # without the i18n module
     _ = lambda x:x
 
-from .local.GoogleAPI import searchEngine
+from .local.GoogleAPI import (searchEngine, httpTransport, breaker,
+        CacheResults, Federated)
+from .local.transport import RecordTransport, ReplayTransport
+from .local.metrics import metrics
+from .local.utils import SessionStore, Deadline
+from .local.queries import ResultCache
+from .local.refresh import CacheRefresher
+from .local.quota import RateLimiter
+from .local.workers import WorkerPool
+from .local.exceptions import APIError, PoolFullError
 
 def validateEngine(irc, msg, args, state):
     """Validate engines."""
@@ -52,6 +64,34 @@ addConverter('validateEngine', validateEngine)
 def isChannel(s):
     return True if s.startswith('#') else False
 
+# Seconds between checks for idle search sessions.
+SESSION_CHECK = 60
+
+REFRESH_VALUES = ('cacheRefresh', 'cacheRefreshMargin', 'cacheRefreshMinHits',
+    'cacheRefreshQuota')
+
+# (option, registry value) pairs compiled into Options.
+OPTIONS = (('engine', 'defaultEngine'), ('number', 'maxPageResults'),
+    ('maxDisplayResults', 'maxDisplayResults'),
+    ('snippet', 'includeSnippet'), ('safe', 'safeLevel'),
+    ('maxPages', 'maxPages'), ('engineAPI', 'engineAPI'),
+    ('prefetch', 'prefetchPages'), ('channelQuota', 'channelDailyQuota'))
+
+class Options(collections.namedtuple('Options',
+        [option for option, name in OPTIONS])):
+    """Immutable snapshot of the plugins.googleCSE values of a channel."""
+    __slots__ = ()
+
+    def override(self, opts):
+        """Return a copy with the command options opts applied."""
+        if not opts:
+            return self
+        return self._replace(**dict(opts))
+
+    def params(self):
+        """Return a new search parameters dict for an engine."""
+        return dict(zip(self._fields, self))
+
 class GoogleCSE(callbacks.Plugin):
     """The GoogleCSE plugin enables searching via their CSEv1 API"""
     home = 'https://github.com/joulez/GoogleCSE'
@@ -60,10 +100,211 @@ class GoogleCSE(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(GoogleCSE, self)
         self.__parent.__init__(irc)
-        self._test_response = None
-        self.opts = {}
-        self.engine = {}
+        self._options = {}
+        self._watched = {}
+        for option, name in OPTIONS:
+            self._watch(conf.supybot.plugins.GoogleCSE.get(name))
+        self.engine = SessionStore(sizeof=lambda eng: eng.memoryUsage(),
+                onEvict=self._evicted)
         self._current = {} #cache current results
+        dbpath = conf.supybot.directories.data.dirize('GoogleCSE.sqlite3')
+        self._cache = ResultCache(dbpath)
+        self._limiter = RateLimiter(dbpath)
+        self._workers = WorkerPool()
+        self._refresher = CacheRefresher(self._cache)
+        self.configurePool()
+        self.configureTransport()
+        self.configureBreaker()
+        for name in ('poolSize', 'connectTimeout', 'readTimeout'):
+            conf.supybot.plugins.GoogleCSE.get(name).addCallback(
+                    self.configurePool)
+        for name in ('breakerThreshold', 'breakerCooldown'):
+            conf.supybot.plugins.GoogleCSE.get(name).addCallback(
+                    self.configureBreaker)
+        for name in ('transport', 'cassetteDirectory'):
+            conf.supybot.plugins.GoogleCSE.get(name).addCallback(
+                    self.configureTransport)
+        self.configureMetrics()
+        conf.supybot.plugins.GoogleCSE.metricsInterval.addCallback(
+                self.configureMetrics)
+        self.configureRefresher()
+        for name in REFRESH_VALUES:
+            conf.supybot.plugins.GoogleCSE.get(name).addCallback(
+                    self.configureRefresher)
+        schedule.addPeriodicEvent(self.expireSessions, SESSION_CHECK,
+                'GoogleCSE.sessions', now=False)
+
+    def die(self):
+        for name in ('poolSize', 'connectTimeout', 'readTimeout'):
+            conf.supybot.plugins.GoogleCSE.get(name).removeCallback(
+                    self.configurePool)
+        for name in ('breakerThreshold', 'breakerCooldown'):
+            conf.supybot.plugins.GoogleCSE.get(name).removeCallback(
+                    self.configureBreaker)
+        for name in ('transport', 'cassetteDirectory'):
+            conf.supybot.plugins.GoogleCSE.get(name).removeCallback(
+                    self.configureTransport)
+        conf.supybot.plugins.GoogleCSE.metricsInterval.removeCallback(
+                self.configureMetrics)
+        for name in REFRESH_VALUES:
+            conf.supybot.plugins.GoogleCSE.get(name).removeCallback(
+                    self.configureRefresher)
+        self._removeEvent('GoogleCSE.metrics')
+        self._removeEvent('GoogleCSE.sessions')
+        for value in self._watched.values():
+            value.removeCallback(self._invalidateOptions)
+        httpTransport.close()
+        self._workers.stop()
+        self._limiter.close()
+        self._cache.close()
+        self.__parent.die()
+
+    def configurePool(self):
+        httpTransport.configure(poolSize=self.registryValue('poolSize'),
+            connectTimeout=self.registryValue('connectTimeout'),
+            readTimeout=self.registryValue('readTimeout'))
+
+    def configureBreaker(self):
+        breaker.threshold = self.registryValue('breakerThreshold')
+        breaker.cooldown = self.registryValue('breakerCooldown')
+
+    def configureTransport(self):
+        """Select the transport engines send their requests through."""
+        mode = self.registryValue('transport')
+        directory = self.registryValue('cassetteDirectory') or \
+            conf.supybot.directories.data.dirize('GoogleCSE-cassettes')
+        if mode == 'replay':
+            self.transport = ReplayTransport(directory)
+        elif mode == 'record':
+            self.transport = RecordTransport(httpTransport, directory)
+        else:
+            self.transport = httpTransport
+
+    def configureMetrics(self):
+        """(Re)schedule writing the metrics file every metricsInterval
+        seconds."""
+        self._removeEvent('GoogleCSE.metrics')
+        schedule.addPeriodicEvent(self.writeMetrics,
+                self.registryValue('metricsInterval'), 'GoogleCSE.metrics',
+                now=False)
+
+    def _removeEvent(self, name):
+        try:
+            schedule.removePeriodicEvent(name)
+        except KeyError:
+            pass
+
+    def writeMetrics(self):
+        path = self.registryValue('metricsFile')
+        if not path:
+            return
+        try:
+            metrics.write(path)
+        except EnvironmentError as e:
+            self.log.warning('Could not write metrics to %s: %s', path, e)
+
+    def configureRefresher(self):
+        self._refresher.interval = self.registryValue('cacheRefresh')
+        self._refresher.margin = self.registryValue('cacheRefreshMargin')
+        self._refresher.minHits = self.registryValue('cacheRefreshMinHits')
+        self._refresher.share = self.registryValue('cacheRefreshQuota')
+
+    def __call__(self, irc, msg):
+        self.__parent.__call__(irc, msg)
+        if self._refresher.due():
+            try:
+                self._workers.submit(self.refreshCache,
+                        key='GoogleCSE.refresh')
+            except PoolFullError:
+                self._refresher.done()
+
+    def refreshCache(self):
+        """Re-fetch the popular cached searches that are about to expire.
+        Returns the number of refreshed pages."""
+        cache = self.getCache()
+        if cache is None:
+            self._refresher.done()
+            return 0
+        limiter = self.getLimiter()
+        apikey = self.registryValue('apikey')
+        unordered = self.registryValue('unorderedQueries')
+        name, remaining, capacity = limiter.status(apikey or None)[0]
+
+        def fetch(row):
+            kwargs = {}
+            if row['engine'] == 'cse':
+                if not apikey:
+                    raise APIError('No API key configured.')
+                kwargs = {'api_key': apikey, 'engine_id': row['cx']}
+            params = {'number': row['num']}
+            if row['fields'] is not None:
+                params['fields'] = row['fields']
+            eng = searchEngine(row['engine'], row['original'], params,
+                    cache=cache, limiter=limiter, transport=self.transport,
+                    unordered=unordered, **kwargs)
+            if row['start'] is not None:
+                eng['start'] = row['start']
+            eng.refresh()
+
+        def errback(row, e):
+            metrics.incr('cache.refreshFailed')
+            self.log.info(format('Could not refresh cached search %q: %s',
+                row['original'], e))
+
+        count = self._refresher.refresh(fetch, remaining, errback)
+        metrics.incr('cache.refreshed', count)
+        return count
+
+    def dispatch(self, irc, fetch, deliver, error=None, key=None):
+        """Call deliver() with the result of fetch().
+
+        With plugins.googleCSE.threadedSearch enabled fetch() runs on the
+        worker pool and deliver() is called from the worker thread. A newer
+        job with the same key cancels a pending one. If error is given it is
+        replied when fetch() fails.
+        """
+        if not self.registryValue('threadedSearch'):
+            try:
+                result = fetch()
+            except APIError as e:
+                return irc.error(e.message)
+            except Exception:
+                if error is None:
+                    raise
+                return irc.error(error)
+            return deliver(result)
+
+        def errback(e):
+            if isinstance(e, APIError):
+                return irc.error(e.message)
+            if error is not None:
+                return irc.error(error)
+            self.log.exception('Search failed:')
+            irc.error(utils.exnToString(e))
+
+        self._workers.workers = self.registryValue('workerThreads')
+        self._workers.maxQueue = self.registryValue('workerQueueSize')
+        try:
+            self._workers.submit(fetch, deliver, errback, key)
+        except PoolFullError:
+            irc.error('Too many searches in progress, try again later.')
+
+    def _evicted(self, channel, eng, reason):
+        self._current.pop(channel, None)
+        self.log.info(format('Search session for %s evicted (%s). %n'
+            ' active, %i bytes.', channel, reason,
+            (len(self.engine), 'session'), self.engine.memory))
+
+    def configureSessions(self):
+        self.engine.maxSessions = self.registryValue('maxSessions')
+        self.engine.timeout = self.registryValue('sessionTimeout')
+        self.engine.maxMemory = self.registryValue('maxSessionMemory')
+
+    def expireSessions(self):
+        """Drop idle sessions, also in channels where nobody searches
+        anymore."""
+        self.configureSessions()
+        self.engine.expire()
 
     def _error(self, error):
         self.irc.error(error, Raise=True)
@@ -75,97 +316,179 @@ class GoogleCSE(callbacks.Plugin):
                 Raise=True)
         return apikey
 
-    def setOpts(self, channel, opts=None):
-        if not isChannel(channel):
-            channel = None
-        self.opts['engine'] = self.registryValue('defaultEngine', channel)
-        self.opts['number'] = self.registryValue('maxPageResults', channel)
-        self.opts['maxDisplayResults'] = self.registryValue('maxDisplayResults',
-                channel)
-        self.opts['snippet'] = self.registryValue('includeSnippet', channel)
-        self.opts['safe'] = self.registryValue('safeLevel', channel)
-        self.opts['maxPages'] = self.registryValue('maxPages', channel)
-        self.opts['engineAPI'] = self.registryValue('engineAPI', channel)
-        if opts:
-            for option, arg in opts:
-                self.opts[option] = arg
+    def getCache(self):
+        """Return the result cache, or None if caching is disabled."""
+        if not self.registryValue('cache'):
+            return None
+        self._cache.ttl = self.registryValue('cacheTTL')
+        self._cache.maxEntries = self.registryValue('cacheMaxEntries')
+        self._cache.stale = self.registryValue('cacheStale')
+        self._cache.emptyTtl = self.registryValue('cacheEmptyTTL')
+        self._cache.errorTtl = self.registryValue('cacheErrorTTL')
+        return self._cache
+
+    def getDeadline(self):
+        """Return the Deadline of a command starting now, or None if
+        commands have no time limit."""
+        seconds = self.registryValue('searchTimeout')
+        if not seconds:
+            return None
+        return Deadline(seconds)
+
+    def getLimiter(self):
+        self._limiter.daily = self.registryValue('dailyQuota')
+        self._limiter.perSecond = self.registryValue('requestsPerSecond')
+        return self._limiter
+
+    def getOptions(self, channel, opts=None):
+        """Return the Options of channel with the command options opts
+        applied."""
+        with metrics.timer('opts'):
+            if not isChannel(channel):
+                channel = None
+            options = self._options.get(channel)
+            if options is None:
+                options = self._options[channel] = \
+                    self._compileOptions(channel)
+            return options.override(opts)
+
+    def _compileOptions(self, channel):
+        values = []
+        for option, name in OPTIONS:
+            value = self.registryValue(name, channel, value=False)
+            self._watch(value)
+            values.append(value())
+        return Options(*values)
 
-    def formatOutput(self, channel, page, nav):
-        l = []
-        ctr = 0
-        max = self.registryValue('maxDisplayResults')
+    def _watch(self, value):
+        """Invalidate the compiled options when value changes. Changes of a
+        global value reach its inheriting channel values too."""
+        if id(value) not in self._watched:
+            self._watched[id(value)] = value
+            value.addCallback(self._invalidateOptions)
+
+    def _invalidateOptions(self):
+        self._options = {}
+
+    def formatOutput(self, options, page, nav):
+        with metrics.timer('format'):
+            return self._formatOutput(options, page, nav)
+
+    def _formatOutput(self, options, page, nav):
         def rebold(s):
             return s.replace('<b>', '\x02').replace('</b>', '\x02')
 
-        def setFormat(title, link):
+        snippet = options.snippet
+        engineAPI = options.engineAPI
+        # Lines are memoized on the item for the options that affect them.
+        key = (snippet, engineAPI)
+
+        def setFormat(item):
             v= format('%s: %u', ircutils.bold(item.title), item.link)
-            if self.opts['snippet']:
+            if snippet:
                 v += format(' %s',(item.snippet.replace('\n','')))
-                if self.opts['engineAPI'] == 'legacy':
+                if engineAPI == 'legacy':
                     v = rebold(v)
             return v
 
-        if isChannel(channel):
-            max = self.registryValue('maxDisplayResults', channel)
-        try:
-            while ctr < max:
-                ctr += 1
-                if nav == 'next':
-                    item = page.nextItem()
-                    l.append(setFormat(item.title, item.link))
-                else:
-                    item = page.previousItem()
-                    l.insert(0, setFormat(item.title, item.link))
-        except:
-            return l
-        return l
-
-    def _next(self, caller):
-        if self._test_response:
-            self.engine[caller].response = self._test_response
-            self.engine[caller]._test_feed = True
-        return self.engine[caller].next()
+        return [item.rendered(key, setFormat) for item in
+            page.itemWindow(options.maxDisplayResults, nav)]
 
     def evalQuery(self, query):
         return re.sub('["\']', '', query.strip())
 
     @wrap([getopts({'engine': 'somethingWithoutSpaces', 'number': 'Int',
-        'snippet': ''}), 'text'])
+        'snippet': '', 'no-cache': '', 'all': ''}), 'text'])
     def search(self, irc, msg, args, opts, query):
-        """[--engine <CSE Code>] [--number <value>] [--snippet] query
+        """[--engine <CSE Code>] [--all] [--number <value>] [--snippet]
+        [--no-cache] query
 
         Standard basic search. Uses the channel configured engine by default.
-        See plugins.googlecse.defaultEngine
+        See plugins.googlecse.defaultEngine. With --all every engine in
+        plugins.googlecse.engines is searched and the results are merged.
+        With --no-cache the result cache is bypassed; use "cache add" to
+        store the results afterwards.
         """
         self.irc = irc
+        deadline = self.getDeadline()
         if not self.evalQuery(query):
             return irc.error()
-        self.setOpts(msg.args[0], opts)
-        if self.opts['engineAPI'] == 'cse':
+        channel = msg.args[0]
+        opts = dict(opts)
+        useCache = not opts.pop('no-cache', False)
+        federated = opts.pop('all', False)
+        options = self.getOptions(channel, opts)
+        engineOpts = {'cache': self.getCache(),
+                'useCache': useCache,
+                'prefetch': options.prefetch,
+                'limiter': self.getLimiter(),
+                'transport': self.transport,
+                'unordered': self.registryValue('unorderedQueries'),
+                'deadline': deadline,
+                'retries': self.registryValue('retries'),
+                'backoff': self.registryValue('retryBackoff')}
+        if isChannel(channel):
+            engineOpts['channel'] = channel
+            engineOpts['channelQuota'] = options.channelQuota
+        if federated:
+            eng = self.federatedEngine(query, options, engineOpts)
+        elif options.engineAPI == 'cse':
             apikey = self.getAPIKey()
-            if not self.opts.get('engine'):
+            if not options.engine:
                 self._error('A search engine is required use --engine or'
                         ' configure a default engine for the channel')
-            self.engine[msg.args[0]] = searchEngine(self.opts['engineAPI'],
-                query, self.opts, api_key=apikey, 
-                engine_id=self.opts['engine'])
+            eng = searchEngine(options.engineAPI,
+                query, options.params(), api_key=apikey,
+                engine_id=options.engine, **engineOpts)
             self.log.info(format('\"%s\" Search Engine API created with'
-                ' custom engine ID \"%s\"', self.opts['engineAPI'],
-                self.opts['engine']))
+                ' custom engine ID \"%s\"', options.engineAPI,
+                options.engine))
         else:
-            self.engine[msg.args[0]] = searchEngine(self.opts['engineAPI'],
-                    query, self.opts)
+            eng = searchEngine(options.engineAPI,
+                    query, options.params(), **engineOpts)
             self.log.info(format('\"%s\" Search Engine API initialized',
-                    self.opts['engineAPI']))
-        page = self._next(msg.args[0])
-        if page.count == 0:
-            return irc.reply('No results found.')
-        fList = self.formatOutput(msg.args[0], page, 'next')
-        self._current[msg.args[0]] = fList
-        return self.printResults(fList)
+                    options.engineAPI))
+        return self.dispatch(irc, eng.next,
+                lambda page: self.deliver(irc, channel, eng, options, page),
+                key=channel)
+
+    def federatedEngine(self, query, options, engineOpts):
+        """Return a Federated engine searching the first page of every
+        engine in plugins.googleCSE.engines."""
+        if options.engineAPI != 'cse':
+            self._error('Searching all engines requires the cse engine API.')
+        engines = self.registryValue('engines')
+        if not engines:
+            self._error('No search engines configured, see'
+                    ' plugins.googleCSE.engines.')
+        apikey = self.getAPIKey()
+        params = options.params()
+        params['maxPages'] = 1
+        subOpts = dict(engineOpts, prefetch=False)
+        eng = Federated(query, [searchEngine('cse', query, dict(params),
+            api_key=apikey, engine_id=engine, **subOpts)
+            for engine in engines], options.params(),
+            timeout=self.registryValue('federatedTimeout'),
+            deadline=engineOpts['deadline'])
+        self.log.info(format('Searching %n: %L', (len(engines), 'engine'),
+            engines))
+        return eng
 
     google = search
 
+    def deliver(self, irc, channel, eng, options, page):
+        """Make eng the search session of channel and reply the first
+        results of page."""
+        # Navigation renders with the options of the search.
+        eng.options = options
+        self.configureSessions()
+        self.engine[channel] = eng
+        if page.count == 0:
+            return irc.reply('No results found.')
+        fList = self.formatOutput(options, page, 'next')
+        self._current[channel] = fList
+        return self.printResults(fList, irc)
+
     @wrap
     def current(self, irc, msg, args):
         """Returns previously cached results."""
@@ -183,7 +506,7 @@ class GoogleCSE(callbacks.Plugin):
         eng = self.engine.get(msg.args[0])
         if eng:
             page = eng.currentPage
-            fList = self.formatOutput(msg.args[0], page, 'next')
+            fList = self.formatOutput(eng.options, page, 'next')
             if fList:
                 if isChannel(msg.args[0]):
                     self._current[msg.args[0]] = fList
@@ -199,7 +522,7 @@ class GoogleCSE(callbacks.Plugin):
         eng = self.engine.get(msg.args[0])
         if eng:
             page = eng.currentPage
-            fList = self.formatOutput(msg.args[0], page, 'previous')
+            fList = self.formatOutput(eng.options, page, 'previous')
             if fList:
                 if isChannel(msg.args[0]):
                     self._current[msg.args[0]] = fList
@@ -213,11 +536,13 @@ class GoogleCSE(callbacks.Plugin):
         """Cue the next page."""
         eng = self.engine.get(msg.args[0])
         if eng:
-            try:
-                page = eng.next()
-                return irc.reply(format('Current page startIndex: %i',page.startIndex))
-            except:
+            if not eng.hasNext():
                 return irc.error('No next pages.')
+            eng.deadline = self.getDeadline()
+            def deliver(page):
+                return irc.reply(format('Current page startIndex: %i',
+                    page.startIndex))
+            return self.dispatch(irc, eng.next, deliver)
         return irc.error('No active search.')
 
     @wrap
@@ -225,58 +550,133 @@ class GoogleCSE(callbacks.Plugin):
         """Cue the previous page."""
         eng = self.engine.get(msg.args[0])
         if eng:
-            try:
-                page = eng.previous()
-                return irc.reply(format('Current page startIndex: %i',page.startIndex))
-            except:
+            if not eng.hasPrevious():
                 return irc.error('No previous pages.')
+            page = eng.previous()
+            return irc.reply(format('Current page startIndex: %i',
+                page.startIndex))
         return irc.error('No active search.')
 
-    def printResults(self, L):
-        if len(L) > 1:
-            self.irc.replies(L)
-        else:
-            self.irc.reply(L[0])
+    @wrap
+    def quota(self, irc, msg, args):
+        """takes no arguments
 
-    @wrap(['text'])
-    def cache(self, irc, msg, args, query):
-        """<query>
-        Search the cache for matches and load the results.
+        Returns the remaining daily search quota for the API key and the
+        channel.
         """
-        self.irc = irc
+        channel = msg.args[0]
+        if not isChannel(channel):
+            channel = None
+        options = self.getOptions(msg.args[0])
+        apikey = None
+        if options.engineAPI == 'cse':
+            apikey = self.registryValue('apikey')
+        channelQuota = 0
+        if channel:
+            channelQuota = options.channelQuota
+        status = self.getLimiter().status(apikey, channel, channelQuota)
+        names = ('Daily quota', format('%s quota', channel))
+        irc.reply(format('%L', ['%s: %s/%s' % (names[i], remaining, capacity)
+            for i, (name, remaining, capacity) in enumerate(status)]))
+
+    @wrap(['admin', getopts({'reset': ''})])
+    def stats(self, irc, msg, args, opts):
+        """[--reset]
+
+        Returns latency percentiles of the search phases (opts, http,
+        decode, parse, format, reply) and the cache and quota counters.
+        With --reset the measurements are cleared afterwards.
+        """
+        lines = metrics.summary()
+        lines.append(format('Sessions: %i, %i bytes. Cache: %n. Circuit'
+            ' breaker: %s.', len(self.engine), self.engine.memory,
+            (len(self._cache), 'page'), breaker.state))
+        irc.replies(lines)
+        if opts:
+            metrics.reset()
+
+    def printResults(self, L, irc=None):
+        irc = irc or self.irc
+        with metrics.timer('reply'):
+            if len(L) > 1:
+                irc.replies(L)
+            else:
+                irc.reply(L[0])
 
     class cache(callbacks.Commands):
+        def _getCache(self, irc):
+            cache = irc.getCallback('GoogleCSE').getCache()
+            if cache is None:
+                irc.error('The result cache is disabled.', Raise=True)
+            return cache
+
+        @wrap(['text'])
+        def cache(self, irc, msg, args, query):
+            """<query>
+
+            Search the cached results for matches and load them like the
+            results of a search.
+            """
+            plugin = irc.getCallback('GoogleCSE')
+            cache = self._getCache(irc)
+            if not cache.indexed:
+                return irc.error('Full-text search is not supported by this'
+                        ' SQLite version.')
+            channel = msg.args[0]
+            options = plugin.getOptions(channel)
+            with metrics.timer('index'):
+                items = cache.search(query,
+                        options.number * max(options.maxPages, 1))
+            if not items:
+                return irc.reply('No cached results found.')
+            eng = CacheResults(query, items, options.params())
+            plugin.deliver(irc, channel, eng, options, eng.next())
+
         @wrap
         def list(self, irc, msg, args):
             """List search cache."""
+            rows = self._getCache(irc).list()
+            if not rows:
+                return irc.reply('The result cache is empty.')
+            irc.replies([format('%i: %s (%s, start %s, %n)', row['id'],
+                ircutils.bold(row['original']), row['engine'], row['start'] or 1,
+                (row['hits'], 'hit')) for row in rows])
 
         @wrap
         def add(self, irc, msg, args):
             """Add current search result to the cache if not
             already added."""
+            self._getCache(irc)
+            eng = irc.getCallback('GoogleCSE').engine.get(msg.args[0])
+            if not eng:
+                return irc.error('No active search.')
+            count = eng.saveCache()
+            if not count:
+                return irc.reply('Current search is already cached.')
+            irc.reply(format('Added %n to the cache.', (count, 'page')))
 
         @wrap(['positiveInt'])
         def remove(self, irc, msg, args, id):
             """<id>
             Remove cache with <id>.
             """
+            if not self._getCache(irc).remove(id):
+                return irc.error(format('No cache with id %i.', id))
+            irc.replySuccess()
+
     @wrap
     def about(self, irc, msg, *args):
         """<about>
         Return information about the plugin.
         """
         self.irc = irc
-        self.setOpts(msg.args[0])
+        options = self.getOptions(msg.args[0])
         irc.reply(format('%s - Google Custom Search Engine plugin '
             '(Engine API: %s) for the Limnoria IRC bot %u',
             ircutils.bold(self.__class__.__name__),
-            ircutils.bold(self.opts['engineAPI']),
+            ircutils.bold(options.engineAPI),
             ircutils.bold(self.home)))
 
-    def _test_feed(self, response):
-        """Testing purposes, feed a DResponse object from ./local/test.py"""
-        self._test_response = response
-
 Class = GoogleCSE
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
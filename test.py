@@ -30,8 +30,11 @@
 ###
 import os
 import json
+import time
+import supybot.schedule as schedule
 from supybot.test import *
 from .local.test import DResponse
+from .local.transport import StaticTransport, RecordTransport
 
 dir = os.path.dirname(__file__)
 
@@ -50,7 +53,7 @@ class GoogleCSETestCase(PluginTestCase):
         with open(os.path.join(dir, 'local', 'sampleResultsP1.json'), 'r') as f:
             response = DResponse(json.loads(f.read()))
             response.status_code = 200
-        self.plugin._test_feed(response)
+        self.plugin.transport = StaticTransport(response)
         engineID = 'ENGINE'
         apikey = 'API'
         self.assertNotError('config plugins.googlecse.engineapi cse')
@@ -72,10 +75,10 @@ class GoogleCSETestCase(PluginTestCase):
             f:
             response = DResponse(json.loads(f.read()))
             response.status_code = 200
-        self.plugin._test_feed(response)
+        self.plugin.transport = StaticTransport(response)
         self.assertNotError('config plugins.googlecse.maxpages 2')
         self.assertNotError('googlecse about')
-        self.plugin._test_feed(None)
+        self.plugin.configureTransport()
         self.assertError('googlecse search --engine ENGINE \'\' ')
    
     def test20NoResults(self):
@@ -83,17 +86,21 @@ class GoogleCSETestCase(PluginTestCase):
         with open(fpath, 'r') as f:
             response = DResponse(json.loads(f.read()))
             response.status_code = 200
-        self.plugin._test_feed(response)
+        transport = self.plugin.transport = StaticTransport(response)
         self.assertNotError('config plugins.googlecse.engineapi cse')
         self.assertResponse('googlecse search --engine ENGINE NONE',
                 'No results found.')
+        self.assertResponse('googlecse search --engine ENGINE NONE',
+                'No results found.')
+        self.assertEqual(len(transport.requests), 1)
+        self.plugin.configureTransport()
     
     def testResults(self):
         fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
         with open(fpath, 'r') as f:
             response = DResponse(json.loads(f.read()))
             response.status_code = 200
-        self.plugin._test_feed(response)
+        self.plugin.transport = StaticTransport(response)
         self.assertNotError('config plugins.googlecse.engineapi legacy')
         self.assertNotError('config plugins.googlecse.maxpageresults 4')
         self.assertNotError('config plugins.googlecse.maxdisplayresults 1')
@@ -112,7 +119,7 @@ class GoogleCSETestCase(PluginTestCase):
         with open(fpath, 'r') as f:
             response = DResponse(json.loads(f.read()))
             response.status_code = 200
-        self.plugin._test_feed(response)
+        self.plugin.transport = StaticTransport(response)
         self.assertNotError('config plugins.googlecse.engineapi legacy')
         self.assertNotError('config plugins.googlecse.maxpageresults 4')
         self.assertNotError('config plugins.googlecse.maxdisplayresults 1')
@@ -120,12 +127,232 @@ class GoogleCSETestCase(PluginTestCase):
         self.assertNotError('googlecse search --engine ENGINE python docs')
         self.assertNotError('googlecse current')
     
+    def testPageNavigation(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertNotError('config plugins.googlecse.maxPages 2')
+        self.assertNotError('googlecse search page navigation')
+        self.assertResponse('googlecse previouspage',
+                'Error: No previous pages.')
+        class Broken(object):
+            status_code = 400
+            def json(self):
+                raise ValueError('No JSON object could be decoded')
+        eng = self.plugin.engine[list(self.plugin.engine)[0]]
+        eng.transport = StaticTransport(Broken())
+        self.assertNotError('config supybot.reply.error.detailed True')
+        self.assertRegexp('googlecse nextpage', 'Undecodable response')
+        self.assertNotError('config supybot.reply.error.detailed False')
+        eng.transport = self.plugin.transport
+        self.assertRegexp('googlecse nextpage', 'startIndex')
+        self.assertResponse('googlecse nextpage', 'Error: No next pages.')
+        self.assertRegexp('googlecse previouspage', 'startIndex')
+
+    def testExpireSessions(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        self.plugin.transport = StaticTransport(response)
+        self.assertTrue('GoogleCSE.sessions' in schedule.schedule.events)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertNotError('googlecse search expire test')
+        self.assertEqual(len(self.plugin.engine), 1)
+        self.assertNotError('config plugins.googlecse.sessionTimeout 1')
+        time.sleep(1.1)
+        self.plugin.expireSessions()
+        self.assertEqual(len(self.plugin.engine), 0)
+        self.assertError('googlecse current')
+
+    def testCache(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertError('googlecse cache add')
+        self.assertNotError('googlecse search --no-cache cache test')
+        self.assertRegexp('googlecse cache add', 'Added 1 page')
+        self.assertRegexp('googlecse cache add', 'already cached')
+        self.assertRegexp('googlecse cache list', 'cache test')
+        self.plugin.configureTransport()
+        self.assertNotError('googlecse search cache test')
+        id = self.plugin._cache.list()[0]['id']
+        self.assertNotError('googlecse cache remove %i' % id)
+        self.assertError('googlecse cache remove %i' % id)
+
+    def testCacheSearch(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        transport = self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertNotError('config plugins.googlecse.maxdisplayresults 1')
+        self.assertNotError('googlecse search fulltext search')
+        self.assertRegexp('googlecse cache python documentation',
+                'Python.*documentation')
+        self.assertNotError('googlecse next')
+        self.assertEqual(len(transport.requests), 1)
+        self.assertResponse('googlecse cache zzzz', 'No cached results found.')
+        self.assertRegexp('googlecse cache list', 'fulltext search')
+
+    def testCacheRefresh(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        transport = self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertNotError('googlecse search Refresh Test')
+        self.assertNotError('googlecse search refresh test')
+        self.assertEqual(len(transport.requests), 1)
+        self.assertRegexp('googlecse cache list', 'Refresh Test')
+        self.assertNotError('config plugins.googlecse.cacheRefreshMinHits 1')
+        self.assertNotError('config plugins.googlecse.cacheRefreshMargin'
+                ' 100000')
+        self.assertEqual(self.plugin.refreshCache(), 1)
+        self.assertEqual(len(transport.requests), 2)
+        self.assertEqual(transport.requests[1][1]['q'], 'Refresh Test')
+        self.assertNotError('config plugins.googlecse.cacheRefreshMargin 900')
+        self.assertEqual(self.plugin.refreshCache(), 0)
+        self.assertNotError('config plugins.googlecse.cacheRefreshMinHits 2')
+
+    def testThreadedSearch(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertNotError('config plugins.googlecse.threadedsearch on')
+        self.assertNotError('googlecse search --no-cache threaded')
+        self.assertNotError('googlecse next')
+        self.assertNotError('config plugins.googlecse.threadedsearch off')
+
+    def testRenderedSnippet(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertNotError('config plugins.googlecse.maxdisplayresults 1')
+        self.assertNotRegexp('googlecse search snippets', 'Welcome')
+        self.assertNotError('googlecse next')
+        self.assertNotRegexp('googlecse previous', 'Welcome')
+        self.assertRegexp('googlecse search --snippet snippets', 'Welcome!')
+        self.assertNotError('googlecse next')
+        self.assertRegexp('googlecse previous', 'Welcome!')
+
+    def testQuota(self):
+        fpath = os.path.join(dir, 'local', 'sampleResultsP1.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi cse')
+        self.assertNotError('config plugins.googlecse.apikey API')
+        self.assertRegexp('googlecse quota', 'Daily quota: 100/100')
+        self.assertNotError('config plugins.googlecse.dailyquota 1')
+        self.plugin.getLimiter().reserve('API')
+        self.plugin.configureTransport()
+        self.assertRegexp('googlecse search --no-cache --engine ENGINE quota',
+                'quota exhausted')
+        self.assertNotError('config plugins.googlecse.dailyquota 100')
+
+    def testFederated(self):
+        fpath = os.path.join(dir, 'local', 'sampleResultsP1.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        transport = self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi cse')
+        self.assertNotError('config plugins.googlecse.apikey API')
+        self.assertRegexp('googlecse search --all federated docs',
+                'No search engines configured')
+        self.assertNotError('config plugins.googlecse.engines A, B')
+        self.assertRegexp('googlecse search --all federated docs',
+                'docs.python.org')
+        self.assertEqual(sorted(params['cx'] for url, params in
+            transport.requests), ['A', 'B'])
+        self.assertTrue(self.plugin.engine['test'].currentPage.count <= 10)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertRegexp('googlecse search --all federated docs',
+                'requires the cse engine API')
+        self.assertNotError('config plugins.googlecse.engines ""')
+        self.plugin.configureTransport()
+
+    def testOptions(self):
+        options = self.plugin.getOptions('#test')
+        self.assertTrue(self.plugin.getOptions('#test') is options)
+        override = self.plugin.getOptions('#test', {'snippet': True})
+        self.assertTrue(override.snippet)
+        self.assertFalse(self.plugin.getOptions('#test').snippet)
+        self.assertNotError('config channel #test'
+                ' plugins.googlecse.maxDisplayResults 2')
+        options = self.plugin.getOptions('#test')
+        self.assertEqual(options.maxDisplayResults, 2)
+        self.assertNotError('config plugins.googlecse.maxPages 3')
+        self.assertEqual(self.plugin.getOptions('#test').maxPages, 3)
+        self.assertEqual(self.plugin.getOptions('#test').maxDisplayResults, 2)
+        self.assertEqual(self.plugin.getOptions('nick').maxDisplayResults,
+                conf.supybot.plugins.GoogleCSE.maxDisplayResults())
+        self.assertNotError('config channel #test'
+                ' plugins.googlecse.maxDisplayResults 5')
+        self.assertNotError('config plugins.googlecse.maxPages 1')
+
+    def testStats(self):
+        fpath = os.path.join(dir, 'local', 'sampleLegacyItems.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        self.plugin.transport = StaticTransport(response)
+        self.assertNotError('config plugins.googlecse.engineapi legacy')
+        self.assertNotError('googlecse stats --reset')
+        self.assertNotError('googlecse search --no-cache stats')
+        self.assertRegexp('googlecse stats', 'http: 1 calls')
+        self.assertRegexp('googlecse stats', 'Circuit breaker: closed')
+        path = conf.supybot.directories.data.dirize('metrics.prom')
+        self.assertNotError('config plugins.googlecse.metricsFile %s' % path)
+        self.plugin.writeMetrics()
+        with open(path) as f:
+            self.assertTrue('phase="format"' in f.read())
+        self.assertNotError('config plugins.googlecse.metricsFile ""')
+
+    def testReplay(self):
+        fpath = os.path.join(dir, 'local', 'sampleResultsP1.json')
+        with open(fpath, 'r') as f:
+            response = DResponse(json.loads(f.read()))
+            response.status_code = 200
+        cassettes = conf.supybot.directories.data.dirize('cassettes')
+        self.assertNotError('config plugins.googlecse.engineapi cse')
+        self.assertNotError('config plugins.googlecse.apikey REPLAY')
+        self.assertNotError('config plugins.googlecse.cassetteDirectory %s'
+                % cassettes)
+        self.assertNotError('config plugins.googlecse.transport replay')
+        self.assertRegexp('googlecse search --no-cache --engine ENGINE replay',
+                'No recording')
+        self.plugin.transport = RecordTransport(StaticTransport(response),
+                cassettes)
+        self.assertNotError('googlecse search --no-cache --engine ENGINE'
+                ' replay')
+        self.plugin.configureTransport()
+        self.assertRegexp('googlecse search --no-cache --engine ENGINE replay',
+                'Python')
+        self.assertNotError('config plugins.googlecse.transport http')
+
     def test20LegacyNoResults(self):
         fpath = os.path.join(dir, 'local', 'sampleLegacyNoResults.json')
         with open(fpath, 'r') as f:
             response = DResponse(json.loads(f.read()))
             response.status_code = 200
-        self.plugin._test_feed(response)
+        self.plugin.transport = StaticTransport(response)
         self.assertNotError('config plugins.googlecse.engineapi legacy')
         self.assertResponse('googlecse search --engine ENGINE NONE',
                 'No results found.')
@@ -135,7 +362,7 @@ class GoogleCSETestCase(PluginTestCase):
         with open(fpath, 'r') as f:
             response = DResponse(json.loads(f.read()))
             response.status_code = 200
-        self.plugin._test_feed(response)
+        self.plugin.transport = StaticTransport(response)
         self.assertNotError('config plugins.googlecse.engineapi legacy')
         self.assertNotError('config plugins.googlecse.maxpageresults 4')
         self.assertNotError('config plugins.googlecse.maxdisplayresults 1')
@@ -151,7 +378,6 @@ class GoogleCSETestCase(PluginTestCase):
         
     def test20LegacyEngine(self):
         self.plugin = self.irc.getCallback('googlecse')
-        self.plugin._test_response = None
         self.assertResponse('config plugins.googlecse.engineapi','cse')
         self.assertNotError('config plugins.googlecse.engineapi legacy')
         self.assertNotError('config plugins.googlecse.maxdisplayresults 1')